@@ -13,36 +13,884 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from tqdm import tqdm
-from typing import Union
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
+import hashlib
+import json
+import os
 import pathlib
+import queue
 import requests
+import shutil
+import threading
+import time
 
 CHUNK_SIZE = 16384
 
+# Files smaller than this are always downloaded over a single connection since the
+# overhead of the extra requests outweighs any gain.
+MIN_RANGE_SIZE = 1024 * 1024
+
+# Downloads are written to ``<output_path>.part`` and only renamed to ``output_path``
+# once complete. The checkpoint next to it records what is needed to resume them.
+PART_SUFFIX = ".part"
+CHECKPOINT_SUFFIX = ".part.json"
+
+# Completed downloads have a manifest next to them recording where they came from, so
+# later calls can skip the download or make it conditional.
+MANIFEST_SUFFIX = ".download.json"
+
+# How long in seconds a completed download is trusted before it's revalidated with the
+# server. Can be overridden with the ``ML_DOWNLOAD_MAX_AGE`` environment variable.
+DEFAULT_MAX_AGE = 24 * 60 * 60
+MAX_AGE_ENV_VAR = "ML_DOWNLOAD_MAX_AGE"
+
+# If this environment variable is set to ``1``, the network is never used for files
+# that have already been downloaded.
+OFFLINE_ENV_VAR = "ML_DOWNLOAD_OFFLINE"
+
+# The default number of files ``download_many`` downloads at once
+DEFAULT_MAX_CONCURRENCY = 4
+
+ByteRange = Tuple[int, int]
+
+
+def download_http(
+    url: str,
+    output_path: Union[str, pathlib.Path],
+    connections: int = 1,
+    max_age: Optional[float] = None,
+    offline: Optional[bool] = None,
+    session: Optional[requests.Session] = None,
+    expected_sha256: Optional[str] = None,
+    cache_dir: Optional[Union[str, pathlib.Path]] = None,
+    progress_position: Optional[int] = None,
+) -> None:
+    """
+    Downloads a file over HTTP with a progress bar, skipping the download if the file
+    has already been downloaded.
+
+    Completed downloads are recorded in ``<output_path>.download.json`` along with the
+    ``ETag``, ``Last-Modified``, size and SHA-256 of the file. Within ``max_age`` of the
+    last check the network isn't used at all. After that a conditional request is made
+    which only transfers the file again if it changed on the server.
+
+    The file is written to ``<output_path>.part`` and renamed to ``output_path`` once
+    complete. If a previous download was interrupted and the server reports the same
+    ``ETag`` or ``Last-Modified`` as before, only the missing bytes are fetched.
+
+    Parameters
+    ----------
+    ``url``
+        The URL to download.
+    ``output_path``
+        The path to write the file to.
+    ``connections``
+        The number of connections to download the file over. If more than one and the
+        server supports range requests, the file is split into byte ranges which are
+        fetched concurrently. Otherwise the file is streamed over a single connection.
+    ``max_age``
+        How long in seconds a completed download is trusted without checking with the
+        server. Defaults to ``ML_DOWNLOAD_MAX_AGE`` if set or ``DEFAULT_MAX_AGE``.
+    ``offline``
+        If true, an existing file is always used as-is and it's an error for the file
+        not to exist. Defaults to whether ``ML_DOWNLOAD_OFFLINE`` is set to ``1``.
+    ``session``
+        The session to make requests with. Passing the same session to multiple calls
+        lets them reuse connections. Defaults to a new session for this call.
+    ``expected_sha256``
+        The SHA-256 hex digest the file must have. A download that doesn't match raises
+        an exception and is discarded. A file that already matches is used without
+        checking with the server.
+    ``cache_dir``
+        A content-addressed cache directory shared between downloads, such as
+        ``repo_paths.get_dir_artifacts_downloads()``. Downloaded files are stored in it
+        once by SHA-256 and hard linked to ``output_path``, and files with a known
+        ``expected_sha256`` are linked from it without downloading.
+    ``progress_position``
+        The line to draw the progress bar on, for when several are shown at once. If
+        set, the progress bar is cleared once the download finishes.
+    """
+
+    if session is None:
+        with _create_session(connections) as session:
+            return download_http(
+                url,
+                output_path,
+                connections,
+                max_age,
+                offline,
+                session,
+                expected_sha256,
+                cache_dir,
+                progress_position,
+            )
 
-def download_http(url: str, output_path: Union[str, pathlib.Path]) -> None:
     print(f"Downloading {url!r} to {output_path}...")
 
-    response = requests.get(url, stream=True)
+    if max_age is None:
+        max_age = float(os.environ.get(MAX_AGE_ENV_VAR, DEFAULT_MAX_AGE))
+
+    if offline is None:
+        offline = os.environ.get(OFFLINE_ENV_VAR, "0") == "1"
+
+    manifest = _read_manifest(output_path, url)
+
+    if expected_sha256 is not None:
+        # The content is pinned so there's nothing to gain from asking the server
+        if manifest is not None and manifest["sha256"] == expected_sha256:
+            print("  File already downloaded.")
+            return
+
+        manifest = None
+
+        if cache_dir is not None and _link_from_cache(
+            cache_dir, expected_sha256, output_path
+        ):
+            _write_manifest(output_path, url, {}, expected_sha256)
+
+            print("  File found in download cache.")
+            return
+
+    if offline:
+        if not pathlib.Path(output_path).exists() or (
+            expected_sha256 is not None and _hash_file(output_path) != expected_sha256
+        ):
+            raise Exception(
+                f"file has not been downloaded and downloads are offline (url: {url!r}, output path: {output_path})"
+            )
+
+        print("  File already downloaded (offline).")
+        return
+
+    if manifest is not None and time.time() - manifest["checked_at"] < max_age:
+        print("  File already downloaded.")
+        return
+
+    response = session.get(url, headers=_get_conditional_headers(manifest), stream=True)
     response.raise_for_status()
 
+    if response.status_code == 304:
+        response.close()
+
+        assert manifest is not None
+        _write_manifest(output_path, url, manifest, manifest["sha256"])
+
+        print("  File already downloaded.")
+        return
+
     total_size = int(response.headers.get("content-length", 0))
 
+    # Files without validators in their manifest, such as ones downloaded before
+    # manifests existed, are only checked by size
     if (
         pathlib.Path(output_path).exists()
         and pathlib.Path(output_path).stat().st_size == total_size
+        and (
+            manifest is None
+            or _get_validators(manifest) == _get_validators({})
+            or _get_validators(manifest) == _get_validators(response)
+        )
     ):
-        print("  File already downloaded.")
-        return
+        sha256 = _hash_file(output_path)
+
+        if expected_sha256 is None or sha256 == expected_sha256:
+            response.close()
+            _finish_download(output_path, url, response, sha256, cache_dir)
+
+            print("  File already downloaded.")
+            return
+
+    if _is_encoded(response):
+        # The partial file holds decoded bytes but Content-Length counts encoded ones,
+        # so there's no telling how much of the file a previous attempt wrote
+        _get_part_path(output_path).unlink(missing_ok=True)
+        _get_checkpoint_path(output_path).unlink(missing_ok=True)
+        completed: List[ByteRange] = []
+    else:
+        completed = _read_checkpoint(output_path, url, response, total_size)
+
+    resume_offset = _get_prefix_size(completed)
+
+    if completed:
+        print(f"  Resuming download ({_get_ranges_size(completed)} bytes present).")
+
+    if connections > 1 and total_size >= MIN_RANGE_SIZE and _supports_ranges(response):
+        response.close()
+        _download_ranges(
+            session,
+            url,
+            output_path,
+            response,
+            total_size,
+            connections,
+            completed,
+            progress_position,
+        )
+
+        # Ranges arrive out of order, so the file can only be hashed once complete
+        sha256 = _hash_file(_get_part_path(output_path))
+    else:
+        if resume_offset == total_size > 0:
+            # Interrupted after the last byte was written but before the rename
+            response.close()
+            sha256 = _hash_file(_get_part_path(output_path))
+        else:
+            if resume_offset > 0 and _supports_ranges(response):
+                response.close()
+                response = session.get(
+                    url,
+                    headers={
+                        "Range": f"bytes={resume_offset}-",
+                        "If-Range": _get_if_range(response),
+                    },
+                    stream=True,
+                )
+                response.raise_for_status()
+
+                # The server sends the whole file instead if it changed since the
+                # checkpoint was written
+                if response.status_code != 206:
+                    resume_offset = 0
+            else:
+                resume_offset = 0
+
+            sha256 = _download_stream(
+                output_path, url, response, total_size, resume_offset, progress_position
+            )
+
+    if expected_sha256 is not None and sha256 != expected_sha256:
+        # There's no point resuming a corrupt download
+        _get_part_path(output_path).unlink()
+        _get_checkpoint_path(output_path).unlink(missing_ok=True)
+
+        raise Exception(
+            f"downloaded file does not match expected SHA-256 (url: {url!r}, expected: {expected_sha256}, actual: {sha256})"
+        )
+
+    os.replace(_get_part_path(output_path), output_path)
+    _get_checkpoint_path(output_path).unlink(missing_ok=True)
+
+    _finish_download(output_path, url, response, sha256, cache_dir)
+
+    print("  Download complete.")
+
+
+def download_many(
+    urls_to_paths: Mapping[str, Union[str, pathlib.Path]],
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    connections: int = 1,
+    max_age: Optional[float] = None,
+    offline: Optional[bool] = None,
+    cache_dir: Optional[Union[str, pathlib.Path]] = None,
+) -> None:
+    """
+    Downloads multiple files over HTTP concurrently with ``download_http``, sharing one
+    pool of connections between them.
+
+    Each file gets its own progress bar on its own line as it downloads, below an
+    overall progress bar which counts completed files. A failed download doesn't stop
+    the others.
+
+    Parameters
+    ----------
+    ``urls_to_paths``
+        A mapping of each URL to download to the path to write it to.
+    ``max_concurrency``
+        The maximum number of files to download at once.
+    ``connections``, ``max_age``, ``offline``, ``cache_dir``
+        Passed to ``download_http`` for each file.
+
+    Raises
+    ------
+    ``DownloadError``
+        If any of the downloads failed, once all of them have finished.
+    """
+
+    errors: Dict[str, Exception] = {}
+
+    # The lines below the overall progress bar which aren't being drawn on by a
+    # download. There's one for each download that can run at once.
+    free_positions: "queue.Queue[int]" = queue.Queue()
+
+    for position in range(1, max_concurrency + 1):
+        free_positions.put(position)
+
+    def download(url: str, output_path: Union[str, pathlib.Path]) -> None:
+        position = free_positions.get()
+
+        try:
+            download_http(
+                url,
+                output_path,
+                connections,
+                max_age,
+                offline,
+                session,
+                None,
+                cache_dir,
+                position,
+            )
+        finally:
+            free_positions.put(position)
+
+    with _create_session(max_concurrency * connections) as session, ThreadPoolExecutor(
+        max_workers=max_concurrency
+    ) as executor:
+        futures = {
+            executor.submit(download, url, output_path): url
+            for url, output_path in urls_to_paths.items()
+        }
+
+        with tqdm(total=len(futures), unit="file", position=0) as progress_bar:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as error:
+                    errors[futures[future]] = error
+
+                progress_bar.update(1)
+
+    if errors:
+        raise DownloadError(errors)
+
+
+class DownloadError(Exception):
+    """
+    Raised by ``download_many`` when one or more downloads fail. ``errors`` maps each
+    URL that failed to the exception it failed with.
+    """
+
+    def __init__(self, errors: Dict[str, Exception]) -> None:
+        super().__init__(
+            f"{len(errors)} download(s) failed: "
+            + ", ".join(f"{url!r} ({error})" for url, error in errors.items())
+        )
+
+        self.errors = errors
+
+
+def _create_session(pool_size: int) -> requests.Session:
+    result = requests.Session()
+
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    result.mount("http://", adapter)
+    result.mount("https://", adapter)
+
+    return result
+
+
+def _get_part_path(output_path: Union[str, pathlib.Path]) -> pathlib.Path:
+    return pathlib.Path(f"{output_path}{PART_SUFFIX}")
+
+
+def _get_checkpoint_path(output_path: Union[str, pathlib.Path]) -> pathlib.Path:
+    return pathlib.Path(f"{output_path}{CHECKPOINT_SUFFIX}")
+
+
+def _get_manifest_path(output_path: Union[str, pathlib.Path]) -> pathlib.Path:
+    return pathlib.Path(f"{output_path}{MANIFEST_SUFFIX}")
+
+
+def _get_validators(
+    headers: Union[requests.Response, Mapping[str, Any]],
+) -> Dict[str, Optional[str]]:
+    """
+    Gets the ``ETag`` and ``Last-Modified`` validators from a response, its headers or
+    a manifest.
+    """
+
+    if isinstance(headers, requests.Response):
+        headers = headers.headers
+
+    return {
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last_modified", headers.get("last-modified")),
+    }
+
+
+def _get_conditional_headers(manifest: Optional[Dict[str, Any]]) -> Dict[str, str]:
+    result = {}
+
+    if manifest is not None:
+        if manifest["etag"] is not None:
+            result["If-None-Match"] = manifest["etag"]
+
+        if manifest["last_modified"] is not None:
+            result["If-Modified-Since"] = manifest["last_modified"]
+
+    return result
+
+
+def _hash_file(path: Union[str, pathlib.Path]) -> str:
+    hash = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            hash.update(chunk)
+
+    return hash.hexdigest()
+
+
+def _get_cache_path(cache_dir: Union[str, pathlib.Path], sha256: str) -> pathlib.Path:
+    return pathlib.Path(cache_dir, sha256[:2], sha256)
+
+
+def _link_or_copy(
+    source_path: Union[str, pathlib.Path], output_path: Union[str, pathlib.Path]
+) -> None:
+    """
+    Atomically replaces ``output_path`` with a hard link to ``source_path``, or a copy
+    if the file system doesn't support hard links between them.
+    """
+
+    output_path_temp = pathlib.Path(f"{output_path}.tmp")
+    output_path_temp.unlink(missing_ok=True)
+
+    try:
+        os.link(source_path, output_path_temp)
+    except OSError:
+        shutil.copyfile(source_path, output_path_temp)
+
+    os.replace(output_path_temp, output_path)
+
+
+def _link_from_cache(
+    cache_dir: Union[str, pathlib.Path],
+    sha256: str,
+    output_path: Union[str, pathlib.Path],
+) -> bool:
+    cache_path = _get_cache_path(cache_dir, sha256)
+
+    if not cache_path.exists():
+        return False
+
+    _link_or_copy(cache_path, output_path)
 
-    progress_bar = tqdm(total=total_size, unit="B", unit_scale=True)
+    return True
+
+
+def _add_to_cache(
+    cache_dir: Union[str, pathlib.Path],
+    sha256: str,
+    output_path: Union[str, pathlib.Path],
+) -> None:
+    """
+    Stores ``output_path`` in the cache under ``sha256``. If an identical file is
+    already cached, ``output_path`` is replaced with a link to it so that the content is
+    only stored once.
+    """
+
+    cache_path = _get_cache_path(cache_dir, sha256)
+
+    if cache_path.exists():
+        if not cache_path.samefile(output_path):
+            _link_or_copy(cache_path, output_path)
+    else:
+        os.makedirs(cache_path.parent, exist_ok=True)
+        _link_or_copy(output_path, cache_path)
+
+
+def _finish_download(
+    output_path: Union[str, pathlib.Path],
+    url: str,
+    response: requests.Response,
+    sha256: str,
+    cache_dir: Optional[Union[str, pathlib.Path]],
+) -> None:
+    if cache_dir is not None:
+        _add_to_cache(cache_dir, sha256, output_path)
+
+    _write_manifest(output_path, url, response.headers, sha256)
+
+
+def _write_manifest(
+    output_path: Union[str, pathlib.Path],
+    url: str,
+    headers: Mapping[str, Any],
+    sha256: str,
+) -> None:
+    """
+    Writes the manifest for a completed download. ``headers`` is either the response
+    headers or the previous manifest if the file was unchanged on the server.
+    """
+
+    manifest_path = _get_manifest_path(output_path)
+    manifest_path_temp = pathlib.Path(f"{manifest_path}.tmp")
+
+    with open(manifest_path_temp, "w") as file:
+        json.dump(
+            {
+                "url": url,
+                **_get_validators(headers),
+                "size": pathlib.Path(output_path).stat().st_size,
+                "sha256": sha256,
+                "checked_at": time.time(),
+            },
+            file,
+        )
+
+    os.replace(manifest_path_temp, manifest_path)
+
+
+def _read_manifest(
+    output_path: Union[str, pathlib.Path], url: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Reads the manifest for a completed download. Returns ``None`` if there is no
+    manifest or if the file no longer matches it.
+    """
+
+    manifest_path = _get_manifest_path(output_path)
+
+    if not manifest_path.exists() or not pathlib.Path(output_path).exists():
+        return None
+
+    try:
+        with open(manifest_path, "r") as file:
+            manifest: Dict[str, Any] = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        manifest.get("url") != url
+        or manifest.get("size") != pathlib.Path(output_path).stat().st_size
+    ):
+        return None
+
+    return manifest
+
+
+def _get_if_range(response: requests.Response) -> str:
+    # Weak ETags are not allowed in If-Range
+    etag = response.headers.get("etag")
+
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+
+    return response.headers.get("last-modified", "")
+
+
+def _get_ranges_size(ranges: List[ByteRange]) -> int:
+    return sum(end - start for start, end in ranges)
+
+
+def _get_prefix_size(ranges: List[ByteRange]) -> int:
+    """
+    Gets the number of contiguous bytes in ``ranges`` starting from byte zero.
+    """
+
+    result = 0
+
+    for start, end in sorted(ranges):
+        if start > result:
+            break
+
+        result = max(result, end)
+
+    return result
+
+
+def _write_checkpoint(
+    output_path: Union[str, pathlib.Path],
+    url: str,
+    response: requests.Response,
+    total_size: int,
+    completed: Optional[List[ByteRange]],
+) -> None:
+    """
+    Writes the checkpoint for a partial download. ``completed`` is the list of byte
+    ranges present in the partial file, or ``None`` if the partial file is written
+    sequentially and its size is the number of bytes present.
+    """
+
+    checkpoint_path = _get_checkpoint_path(output_path)
+    checkpoint_path_temp = pathlib.Path(f"{checkpoint_path}.tmp")
+
+    with open(checkpoint_path_temp, "w") as file:
+        json.dump(
+            {
+                "url": url,
+                "total_size": total_size,
+                **_get_validators(response),
+                "completed": completed,
+            },
+            file,
+        )
+
+    os.replace(checkpoint_path_temp, checkpoint_path)
+
+
+def _read_checkpoint(
+    output_path: Union[str, pathlib.Path],
+    url: str,
+    response: requests.Response,
+    total_size: int,
+) -> List[ByteRange]:
+    """
+    Reads the checkpoint for a partial download and returns the byte ranges that are
+    already present in the partial file. Returns an empty list if there is nothing to
+    resume or if the file changed on the server since the checkpoint was written.
+    """
+
+    part_path = _get_part_path(output_path)
+    checkpoint_path = _get_checkpoint_path(output_path)
+
+    if not part_path.exists() or not checkpoint_path.exists():
+        return []
+
+    try:
+        with open(checkpoint_path, "r") as file:
+            checkpoint: Dict[str, Any] = json.load(file)
+    except (OSError, ValueError):
+        return []
+
+    validators = _get_validators(response)
+
+    # Without a validator there's no way to tell if the partial file is still valid
+    if validators["etag"] is None and validators["last_modified"] is None:
+        return []
+
+    if (
+        checkpoint.get("url") != url
+        or checkpoint.get("total_size") != total_size
+        or checkpoint.get("etag") != validators["etag"]
+        or checkpoint.get("last_modified") != validators["last_modified"]
+    ):
+        return []
+
+    completed = checkpoint.get("completed")
+
+    if completed is None:
+        return [(0, min(part_path.stat().st_size, total_size))]
+
+    return [(int(start), int(end)) for start, end in completed if start < end]
+
+
+def _download_stream(
+    output_path: Union[str, pathlib.Path],
+    url: str,
+    response: requests.Response,
+    total_size: int,
+    offset: int,
+    progress_position: Optional[int],
+) -> str:
+    """
+    Streams ``response`` into the partial file starting at ``offset`` and returns the
+    SHA-256 hex digest of the whole file, computed as it's written.
+    """
+
+    # Encoded downloads can't be resumed, see download_http
+    if not _is_encoded(response):
+        _write_checkpoint(output_path, url, response, total_size, None)
+
+    progress_bar = tqdm(
+        total=total_size,
+        initial=offset,
+        unit="B",
+        unit_scale=True,
+        position=progress_position,
+        leave=progress_position is None,
+    )
+    hash = hashlib.sha256()
+
+    with open(_get_part_path(output_path), "r+b" if offset > 0 else "wb") as file:
+        # Bytes from a previous attempt have to be read back to be hashed
+        while file.tell() < offset:
+            chunk = file.read(min(CHUNK_SIZE, offset - file.tell()))
+
+            if not chunk:
+                break
+
+            hash.update(chunk)
+
+        file.truncate(offset)
+        file.seek(offset)
 
-    with open(output_path, "wb") as file:
         for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
             file.write(chunk)
+            hash.update(chunk)
             progress_bar.update(len(chunk))
 
     progress_bar.close()
 
-    print("  Download complete.")
+    return hash.hexdigest()
+
+
+def _is_encoded(response: requests.Response) -> bool:
+    # Content-Length refers to the encoded body when the server compresses it, so it
+    # doesn't line up with the decoded file
+    return "content-encoding" in response.headers
+
+
+def _supports_ranges(response: requests.Response) -> bool:
+    accepts_ranges = response.headers.get("accept-ranges", "").lower() == "bytes"
+
+    return accepts_ranges and not _is_encoded(response)
+
+
+def _split_ranges(total_size: int, count: int) -> List[ByteRange]:
+    """
+    Splits ``total_size`` bytes into at most ``count`` contiguous ``(start, end)``
+    ranges where ``end`` is exclusive.
+    """
+
+    if total_size <= 0:
+        return []
+
+    range_size = -(-total_size // max(count, 1))
+
+    return [
+        (start, min(start + range_size, total_size))
+        for start in range(0, total_size, range_size)
+    ]
+
+
+def _get_missing_ranges(total_size: int, completed: List[ByteRange]) -> List[ByteRange]:
+    """
+    Gets the byte ranges within ``total_size`` bytes that are not in ``completed``.
+    """
+
+    result = []
+    position = 0
+
+    for start, end in sorted(completed):
+        if start > position:
+            result.append((position, start))
+
+        position = max(position, end)
+
+    if position < total_size:
+        result.append((position, total_size))
+
+    return result
+
+
+def _download_range(
+    session: requests.Session,
+    url: str,
+    output_path: Union[str, pathlib.Path],
+    start: int,
+    end: int,
+    progress: List[int],
+    progress_index: int,
+    progress_bar: tqdm,
+    stopped: threading.Event,
+) -> None:
+    response = session.get(
+        url, headers={"Range": f"bytes={start}-{end - 1}"}, stream=True
+    )
+    response.raise_for_status()
+
+    if response.status_code != 206:
+        response.close()
+        raise Exception(
+            f"server ignored range request (url: {url!r}, status: {response.status_code})"
+        )
+
+    with response, open(_get_part_path(output_path), "r+b") as file:
+        file.seek(start)
+
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            # Another range failed or the download was interrupted, so keep what was
+            # written for the checkpoint and give up on the rest
+            if stopped.is_set():
+                return
+
+            file.write(chunk)
+            progress[progress_index] += len(chunk)
+            progress_bar.update(len(chunk))
+
+    if start + progress[progress_index] != end:
+        raise Exception(
+            f"incomplete range download (url: {url!r}, expected: {end - start} bytes, got: {progress[progress_index]} bytes)"
+        )
+
+
+def _download_ranges(
+    session: requests.Session,
+    url: str,
+    output_path: Union[str, pathlib.Path],
+    response: requests.Response,
+    total_size: int,
+    connections: int,
+    completed: List[ByteRange],
+    progress_position: Optional[int],
+) -> None:
+    # Each missing range is split so that a fresh download uses exactly one range per
+    # connection
+    ranges = [
+        (missing_start + start, missing_start + end)
+        for missing_start, missing_end in _get_missing_ranges(total_size, completed)
+        for start, end in _split_ranges(missing_end - missing_start, connections)
+    ]
+
+    # Bytes written so far for each range
+    progress = [0] * len(ranges)
+    checkpoint_lock = threading.Lock()
+
+    def write_checkpoint() -> None:
+        with checkpoint_lock:
+            _write_checkpoint(
+                output_path,
+                url,
+                response,
+                total_size,
+                completed
+                + [
+                    (start, start + written)
+                    for (start, _), written in zip(ranges, progress)
+                    if written > 0
+                ],
+            )
+
+    # Preallocate the output file so each range can be written in place
+    with open(_get_part_path(output_path), "r+b" if completed else "wb") as file:
+        file.truncate(total_size)
+
+    write_checkpoint()
+
+    progress_bar = tqdm(
+        total=total_size,
+        initial=_get_ranges_size(completed),
+        unit="B",
+        unit_scale=True,
+        position=progress_position,
+        leave=progress_position is None,
+    )
+
+    stopped = threading.Event()
+
+    def download_range(index: int) -> None:
+        start, end = ranges[index]
+        _download_range(
+            session,
+            url,
+            output_path,
+            start,
+            end,
+            progress,
+            index,
+            progress_bar,
+            stopped,
+        )
+        write_checkpoint()
+
+    executor = ThreadPoolExecutor(max_workers=connections)
+
+    try:
+        for future in [
+            executor.submit(download_range, index) for index in range(len(ranges))
+        ]:
+            future.result()
+    finally:
+        # Stop the other ranges instead of waiting for them to finish when one fails
+        # or on a keyboard interrupt, then wait for the running ones to stop writing
+        # before recording the final checkpoint
+        stopped.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        write_checkpoint()
+        progress_bar.close()
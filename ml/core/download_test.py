@@ -13,11 +13,151 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
+from typing import Any, Dict, Iterator, List, Optional
+import contextlib
+import gzip
+import hashlib
+import http.server
 import os
+import pytest
+import pathlib
+import threading
+import time
 from . import repo_paths
 from . import download
 
 
+class _TestServer:
+    """
+    A local stand-in for a file server which serves ``content`` at ``url`` and records
+    the headers of every request it receives.
+    """
+
+    def __init__(self, content: bytes, accept_ranges: bool) -> None:
+        self.content = content
+        self.accept_ranges = accept_ranges
+        self.etag = '"1"'
+        # If set, each response body is cut off after this many bytes
+        self.fail_after: Optional[int] = None
+        # If set, range requests starting at this byte fail straight away
+        self.fail_range_start: Optional[int] = None
+        # The delay in seconds between writing each chunk of a response body
+        self.chunk_delay = 0.0
+        # If true, full responses are sent gzip-encoded with Content-Encoding
+        self.gzip = False
+        self.requests: List[Dict[str, str]] = []
+        # The client port of every request, which identifies the connection it used
+        self.client_ports: List[int] = []
+        self.url = ""
+
+
+def _make_handler(server: _TestServer) -> type:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            server.requests.append(dict(self.headers))
+            server.client_ports.append(self.client_address[1])
+
+            if self.path.startswith("/missing"):
+                self.send_error(404)
+                return
+
+            if self.headers.get("If-None-Match") == server.etag:
+                self.send_response(304)
+                self.send_header("ETag", server.etag)
+                self.end_headers()
+                return
+
+            content = server.content
+            range_header = self.headers.get("Range")
+
+            if_range = self.headers.get("If-Range")
+
+            if (
+                server.accept_ranges
+                and range_header is not None
+                and (if_range is None or if_range == server.etag)
+            ):
+                start_text, end_text = range_header[len("bytes=") :].split("-")
+                start = int(start_text)
+                end = int(end_text) if end_text else len(content) - 1
+
+                if start == server.fail_range_start:
+                    self.send_error(500)
+                    return
+
+                body = content[start : end + 1]
+
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+            else:
+                body = content
+                self.send_response(200)
+
+                if server.gzip:
+                    body = gzip.compress(body)
+                    self.send_header("Content-Encoding", "gzip")
+
+            if server.accept_ranges:
+                self.send_header("Accept-Ranges", "bytes")
+
+            self.send_header("ETag", server.etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+
+            if server.chunk_delay > 0:
+                try:
+                    for start in range(0, len(body), download.CHUNK_SIZE):
+                        self.wfile.write(body[start : start + download.CHUNK_SIZE])
+                        time.sleep(server.chunk_delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+            elif server.fail_after is None:
+                self.wfile.write(body)
+            else:
+                self.wfile.write(body[: server.fail_after])
+                self.close_connection = True
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    return Handler
+
+
+@contextlib.contextmanager
+def _serve(content: bytes, accept_ranges: bool = True) -> Iterator[_TestServer]:
+    server = _TestServer(content, accept_ranges)
+    http_server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), _make_handler(server)
+    )
+    server.url = f"http://127.0.0.1:{http_server.server_address[1]}/file.bin"
+
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield server
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+
+
+def _get_requested_size(server: _TestServer) -> int:
+    result = 0
+
+    for headers in server.requests:
+        if "Range" in headers:
+            start, end = headers["Range"][len("bytes=") :].split("-")
+            result += int(end) + 1 - int(start)
+
+    return result
+
+
+def _make_content(size: int) -> bytes:
+    return bytes(i % 251 for i in range(size))
+
+
 def test_download_http() -> None:
     url = "https://sherlock-holm.es/stories/plain-text/cano.txt"
     output_dir = repo_paths.get_dir_artifacts_data_raw("test_download_http")
@@ -34,3 +174,331 @@ def test_download_http() -> None:
 
     assert os.path.exists(output_path)
     assert os.stat(output_path).st_size == 3868223
+
+
+def test_download_http_ranges(tmp_path: pathlib.Path) -> None:
+    content = _make_content(download.MIN_RANGE_SIZE * 3 + 17)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        download.download_http(server.url, output_path, connections=4)
+
+    assert output_path.read_bytes() == content
+    assert sum("Range" in headers for headers in server.requests) == 4
+
+
+def test_download_http_ranges_unsupported(tmp_path: pathlib.Path) -> None:
+    content = _make_content(download.MIN_RANGE_SIZE * 3 + 17)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content, accept_ranges=False) as server:
+        download.download_http(server.url, output_path, connections=4)
+
+    assert output_path.read_bytes() == content
+    assert len(server.requests) == 1
+
+
+def test_download_http_resume(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        server.fail_after = 30000
+
+        with pytest.raises(Exception):
+            download.download_http(server.url, output_path)
+
+        assert not output_path.exists()
+        part_size = (tmp_path / "file.bin.part").stat().st_size
+        assert 0 < part_size <= 30000
+
+        server.fail_after = None
+        download.download_http(server.url, output_path)
+
+    assert output_path.read_bytes() == content
+    assert server.requests[-1]["Range"] == f"bytes={part_size}-"
+    assert not (tmp_path / "file.bin.part").exists()
+    assert not (tmp_path / "file.bin.part.json").exists()
+
+
+def test_download_http_resume_encoded(tmp_path: pathlib.Path) -> None:
+    content = _make_content(1000000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        # Content-Length counts the encoded bytes, so it can't tell how much of the
+        # decoded file was written
+        server.gzip = True
+        server.fail_after = len(gzip.compress(content)) // 2
+
+        with pytest.raises(Exception):
+            download.download_http(server.url, output_path)
+
+        assert not output_path.exists()
+        assert not (tmp_path / "file.bin.part.json").exists()
+
+        server.fail_after = None
+        download.download_http(server.url, output_path)
+
+    assert output_path.read_bytes() == content
+    assert "Range" not in server.requests[-1]
+
+
+def test_download_http_resume_changed(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        server.fail_after = 30000
+
+        with pytest.raises(Exception):
+            download.download_http(server.url, output_path)
+
+        server.content = bytes(reversed(content))
+        server.etag = '"2"'
+        server.fail_after = None
+        download.download_http(server.url, output_path)
+
+    assert output_path.read_bytes() == bytes(reversed(content))
+    assert "Range" not in server.requests[-1]
+
+
+def test_download_http_resume_ranges(tmp_path: pathlib.Path) -> None:
+    content = _make_content(download.MIN_RANGE_SIZE * 3 + 17)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        server.fail_after = 100000
+
+        with pytest.raises(Exception):
+            download.download_http(server.url, output_path, connections=4)
+
+        server.fail_after = None
+        server.requests.clear()
+        download.download_http(server.url, output_path, connections=4)
+
+    assert output_path.read_bytes() == content
+    assert _get_requested_size(server) < len(content)
+
+
+def test_download_http_ranges_failed(tmp_path: pathlib.Path) -> None:
+    content = _make_content(download.MIN_RANGE_SIZE * 4)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        # The other ranges would take several seconds to download
+        server.fail_range_start = 0
+        server.chunk_delay = 0.05
+
+        start_time = time.monotonic()
+
+        with pytest.raises(Exception):
+            download.download_http(server.url, output_path, connections=4)
+
+        assert time.monotonic() - start_time < 2
+
+        server.fail_range_start = None
+        server.chunk_delay = 0.0
+        download.download_http(server.url, output_path, connections=4)
+
+    assert output_path.read_bytes() == content
+
+
+def test_download_http_cached(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        download.download_http(server.url, output_path)
+        download.download_http(server.url, output_path)
+
+    assert output_path.read_bytes() == content
+    assert len(server.requests) == 1
+
+
+def test_download_http_not_modified(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        download.download_http(server.url, output_path)
+        download.download_http(server.url, output_path, max_age=0)
+
+    assert output_path.read_bytes() == content
+    assert len(server.requests) == 2
+    assert server.requests[-1]["If-None-Match"] == server.etag
+
+
+def test_download_http_modified(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        download.download_http(server.url, output_path)
+
+        server.content = bytes(reversed(content))
+        server.etag = '"2"'
+        download.download_http(server.url, output_path, max_age=0)
+
+    assert output_path.read_bytes() == bytes(reversed(content))
+
+
+def test_download_http_offline(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        with pytest.raises(Exception):
+            download.download_http(server.url, output_path, offline=True)
+
+        download.download_http(server.url, output_path)
+        download.download_http(server.url, output_path, max_age=0, offline=True)
+
+    assert output_path.read_bytes() == content
+    assert len(server.requests) == 1
+
+
+def test_download_many(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+
+    with _serve(content) as server:
+        download.download_many(
+            {f"{server.url}?{i}": tmp_path / f"file_{i}.bin" for i in range(8)},
+            max_concurrency=2,
+        )
+
+    for i in range(8):
+        assert (tmp_path / f"file_{i}.bin").read_bytes() == content
+
+    assert len(server.requests) == 8
+    assert len(set(server.client_ports)) <= 2
+
+
+def test_download_many_progress(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    positions: List[Optional[int]] = []
+
+    class RecordingTqdm(download.tqdm):  # type: ignore
+        def __init__(self, *args: Any, **kwargs: Any) -> None:
+            positions.append(kwargs.get("position"))
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(download, "tqdm", RecordingTqdm)
+
+    with _serve(_make_content(100000)) as server:
+        download.download_many(
+            {f"{server.url}?{i}": tmp_path / f"file_{i}.bin" for i in range(8)},
+            max_concurrency=2,
+        )
+
+    # The overall progress bar stays on the first line and each file's progress bar
+    # is drawn on a line of its own below it
+    file_positions = [position for position in positions if position != 0]
+
+    assert positions.count(0) == 1
+    assert len(file_positions) == 8
+    assert set(file_positions) <= {1, 2}
+
+
+def test_download_many_errors(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+
+    with _serve(content) as server:
+        missing_url = server.url.replace("/file.bin", "/missing.bin")
+
+        with pytest.raises(download.DownloadError) as error_info:
+            download.download_many(
+                {
+                    server.url: tmp_path / "file.bin",
+                    missing_url: tmp_path / "missing.bin",
+                }
+            )
+
+    assert list(error_info.value.errors) == [missing_url]
+    assert (tmp_path / "file.bin").read_bytes() == content
+    assert not (tmp_path / "missing.bin").exists()
+
+
+def test_download_http_expected_sha256(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        with pytest.raises(Exception):
+            download.download_http(server.url, output_path, expected_sha256="0" * 64)
+
+        assert not output_path.exists()
+        assert not (tmp_path / "file.bin.part").exists()
+
+        download.download_http(
+            server.url,
+            output_path,
+            max_age=0,
+            expected_sha256=hashlib.sha256(content).hexdigest(),
+        )
+        download.download_http(
+            server.url,
+            output_path,
+            max_age=0,
+            expected_sha256=hashlib.sha256(content).hexdigest(),
+        )
+
+    assert output_path.read_bytes() == content
+    assert len(server.requests) == 2
+
+
+def test_download_http_resume_sha256(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    output_path = tmp_path / "file.bin"
+
+    with _serve(content) as server:
+        server.fail_after = 30000
+
+        with pytest.raises(Exception):
+            download.download_http(server.url, output_path)
+
+        server.fail_after = None
+        download.download_http(
+            server.url,
+            output_path,
+            expected_sha256=hashlib.sha256(content).hexdigest(),
+        )
+
+    assert output_path.read_bytes() == content
+
+
+def test_download_http_cache(tmp_path: pathlib.Path) -> None:
+    content = _make_content(100000)
+    cache_dir = tmp_path / "cache"
+
+    with _serve(content) as server:
+        download.download_http(
+            f"{server.url}?a", tmp_path / "a.bin", cache_dir=cache_dir
+        )
+        download.download_http(
+            f"{server.url}?b", tmp_path / "b.bin", cache_dir=cache_dir
+        )
+        download.download_http(
+            f"{server.url}?c",
+            tmp_path / "c.bin",
+            cache_dir=cache_dir,
+            expected_sha256=hashlib.sha256(content).hexdigest(),
+        )
+
+    assert len(server.requests) == 2
+    assert (tmp_path / "a.bin").samefile(tmp_path / "b.bin")
+    assert (tmp_path / "a.bin").samefile(tmp_path / "c.bin")
+    assert (tmp_path / "c.bin").read_bytes() == content
+
+
+def test_get_missing_ranges() -> None:
+    assert download._get_missing_ranges(10, []) == [(0, 10)]
+    assert download._get_missing_ranges(10, [(2, 4), (0, 1)]) == [(1, 2), (4, 10)]
+    assert download._get_missing_ranges(10, [(0, 10)]) == []
+
+
+def test_split_ranges() -> None:
+    assert download._split_ranges(10, 3) == [(0, 4), (4, 8), (8, 10)]
+    assert download._split_ranges(2, 4) == [(0, 1), (1, 2)]
+    assert download._split_ranges(0, 4) == []
@@ -13,34 +13,672 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from typing import Union
+from typing import cast, Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Union
+import bz2
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
+import os
 import pathlib
+import requests
+import shutil
+import tarfile
+import urllib.parse
 import zipfile
+import zlib
+
+try:
+    import zstandard  # type: ignore[import-not-found, unused-ignore]
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 16384
+
+ZIP_MAGIC = b"PK\x03\x04"
+
+# Magic bytes at the start of each supported compression format
+COMPRESSION_MAGICS = {
+    b"\x1f\x8b": "gz",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zst",
+}
+
+# The file name suffix of a single file compressed with each format
+COMPRESSION_SUFFIXES = {
+    "gz": ".gz",
+    "bz2": ".bz2",
+    "xz": ".xz",
+    "zst": ".zst",
+}
+
+# File name suffixes of tar archives, optionally compressed
+TAR_SUFFIXES = (
+    ".tar",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".tbz",
+    ".tbz2",
+    ".tar.xz",
+    ".txz",
+    ".tar.zst",
+    ".tzst",
+)
 
 
 def extract_archive(
-    archive_path: Union[str, pathlib.Path], extract_dir: Union[str, pathlib.Path]
+    archive_path: Union[str, pathlib.Path],
+    extract_dir: Union[str, pathlib.Path],
+    workers: int = 1,
+    verify: bool = False,
 ) -> None:
+    """
+    Extracts an archive with a progress bar, skipping members that have already been
+    extracted.
+
+    Zip archives, tar archives and single compressed files are supported. Tar archives
+    can be uncompressed, and both can be compressed with gzip, bzip2, xz or, if the
+    ``zstandard`` package is installed, zstd. They're decompressed as they're read
+    without any temporary copies.
+
+    Once extracted, a manifest of the archive's size, modification time and SHA-256, of
+    each zip member's CRC and of the top-level paths of the members is written to
+    ``extract_dir``. If the archive is unchanged and the top-level paths still exist on
+    a later call, extraction is skipped without looking at any members. Otherwise
+    members are only extracted again if they're missing or their content differs,
+    which is detected using the CRCs stored in zip archives.
+
+    Parameters
+    ----------
+    ``archive_path``
+        The path to the archive.
+    ``extract_dir``
+        The directory to extract the archive into.
+    ``workers``
+        The number of threads to extract zip members with. Each thread opens its own
+        handle to the archive, and decompression runs in parallel since zlib releases
+        the GIL.
+    ``verify``
+        If true, the manifest is ignored and the CRC of every extracted member is
+        checked, which catches files that were modified after extraction.
+    """
+
     print(f"Extracting {archive_path} to {extract_dir}...")
 
+    manifest = None if verify else _read_manifest(archive_path, extract_dir)
+
+    if (
+        manifest is not None
+        and _are_top_level_paths_present(extract_dir, manifest)
+        and _is_archive_unchanged(archive_path, manifest["archive"])
+    ):
+        # Record the new modification time of an archive that was touched but not
+        # changed, so that it doesn't need to be hashed again next time
+        if (
+            pathlib.Path(archive_path).stat().st_mtime_ns
+            != manifest["archive"]["mtime_ns"]
+        ):
+            manifest["archive"] = _get_archive_identity(
+                archive_path, manifest["archive"]["sha256"]
+            )
+            _write_manifest(archive_path, extract_dir, manifest)
+
+        print("  Archive already extracted.")
+        return
+
+    if zipfile.is_zipfile(archive_path):
+        members_crcs = _extract_zip(
+            archive_path,
+            extract_dir,
+            workers,
+            {} if manifest is None else manifest["members"],
+        )
+        top_level_paths = _get_top_level_paths(members_crcs)
+    else:
+        with open(archive_path, "rb") as file, tqdm(
+            total=pathlib.Path(archive_path).stat().st_size, unit="B", unit_scale=True
+        ) as progress_bar:
+            top_level_paths = _extract_stream(
+                _ProgressReader(file, progress_bar),
+                pathlib.Path(archive_path).name,
+                extract_dir,
+            )
+
+        members_crcs = {}
+
+    _write_manifest(
+        archive_path,
+        extract_dir,
+        {
+            "archive": _get_archive_identity(archive_path),
+            "members": members_crcs,
+            "top_level_paths": top_level_paths,
+        },
+    )
+
+    print("  Extraction complete.")
+
+
+def extract_http(url: str, extract_dir: Union[str, pathlib.Path]) -> None:
+    """
+    Downloads an archive over HTTP and extracts it as it downloads, without writing
+    the archive to disk.
+
+    Only formats that can be read sequentially are supported, which are the same as
+    for ``extract_archive`` except for zip archives. The format is detected from the
+    file name in the URL and the first bytes of the download.
+
+    Parameters
+    ----------
+    ``url``
+        The URL of the archive.
+    ``extract_dir``
+        The directory to extract the archive into.
+    """
+
+    print(f"Extracting {url!r} to {extract_dir}...")
+
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+
+    # Only undo any transfer compression, the archive itself is decompressed below
+    response.raw.decode_content = True
+
+    with response, tqdm(
+        total=int(response.headers.get("content-length", 0)),
+        unit="B",
+        unit_scale=True,
+    ) as progress_bar:
+        reader = _ProgressReader(cast(BinaryIO, response.raw), progress_bar)
+
+        if reader.peek(len(ZIP_MAGIC)) == ZIP_MAGIC:
+            raise Exception(
+                f"zip archives cannot be extracted while downloading, use download_http and extract_archive instead (url: {url!r})"
+            )
+
+        _extract_stream(
+            reader,
+            pathlib.PurePosixPath(urllib.parse.urlparse(url).path).name,
+            extract_dir,
+        )
+
+    print("  Extraction complete.")
+
+
+@contextlib.contextmanager
+def open_archive(
+    archive_path: Union[str, pathlib.Path], at: str = ""
+) -> Iterator[zipfile.Path]:
+    """
+    Opens a zip archive so that its members can be read in place without extracting
+    them, closing it and its memory map on exit. The result supports the reading parts of the ``pathlib.Path`` interface, such
+    as ``iterdir``, ``name`` and ``open``, so loaders that read from a directory can
+    read from a directory inside the archive instead.
+
+    The archive is memory mapped, so reading stored members copies straight out of the
+    page cache instead of making a read call for each chunk. The archive can't be
+    replaced on Windows while it's mapped, so it should be closed once it's read.
+
+    Parameters
+    ----------
+    ``archive_path``
+        The path to the zip archive.
+    ``at``
+        The directory within the archive to open, such as ``"data/names/"``.
+
+    Returns
+    -------
+        A context manager giving a ``zipfile.Path`` to ``at`` within the archive.
+
+    Example
+    -------
+
+    ```python
+    with open_archive("data.zip", "data/names/") as path:
+        names = [file.name for file in path.iterdir()]
+    ```
+    """
+
+    # ZipFile doesn't close file objects that are passed to it
+    with _MappedFile(archive_path) as mapped_file, zipfile.ZipFile(
+        mapped_file
+    ) as zip_file:
+        yield zipfile.Path(zip_file, at)
+
+
+def _extract_zip(
+    archive_path: Union[str, pathlib.Path],
+    extract_dir: Union[str, pathlib.Path],
+    workers: int,
+    extracted_crcs: Dict[str, int],
+) -> Dict[str, int]:
+    """
+    Extracts the members of a zip archive that haven't already been extracted and
+    returns the CRC of every member.
+    """
+
     # Extract archive_path zip to extract_dir with tqdm progress bar by byte count
     with zipfile.ZipFile(archive_path, "r") as zip_file:
         total_size = sum(file.file_size for file in zip_file.infolist())
         progress_bar = tqdm(total=total_size, unit="B", unit_scale=True)
 
+        members: List[zipfile.ZipInfo] = []
+
         for file in zip_file.infolist():
             if not file.is_dir():
-                extracted_path = pathlib.Path(extract_dir, file.filename)
+                if _is_extracted(extract_dir, file, extracted_crcs.get(file.filename)):
+                    progress_bar.update(file.file_size)
+                else:
+                    members.append(file)
+
+        if workers <= 1 or len(members) <= 1:
+            _extract_members(zip_file, extract_dir, members, progress_bar)
+
+        members_crcs = {
+            file.filename: file.CRC for file in zip_file.infolist() if not file.is_dir()
+        }
+
+    if workers > 1 and len(members) > 1:
+        # ZipFile.extract creates missing parent directories without tolerating them
+        # being created concurrently, so create them up front
+        for file in members:
+            os.makedirs(_get_extracted_path(extract_dir, file).parent, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _extract_members_from_path,
+                    archive_path,
+                    extract_dir,
+                    batch,
+                    progress_bar,
+                )
+                for batch in _split_members(members, workers)
+            ]
+
+            for future in futures:
+                future.result()
+
+    progress_bar.close()
+
+    return members_crcs
+
+
+class _MappedFile(io.RawIOBase):
+    """
+    A read-only, seekable file backed by a memory map of ``path``.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]) -> None:
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._map)
+
+        self._position = max(offset, 0)
+
+        return self._position
+
+    def readinto(self, buffer: Any) -> int:
+        data = memoryview(self._map)[self._position : self._position + len(buffer)]
+        size = len(data)
+
+        buffer[:size] = data
+        data.release()
+        self._position += size
+
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self._map.close()
+
+        super().close()
+
+
+class _ProgressReader(io.RawIOBase):
+    """
+    A readable stream that reports the number of bytes read from ``file`` to a progress
+    bar and which can peek at the start of the stream before it's read.
+    """
+
+    def __init__(self, file: BinaryIO, progress_bar: tqdm) -> None:
+        self._file = file
+        self._progress_bar = progress_bar
+        self._peeked = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def peek(self, size: int) -> bytes:
+        while len(self._peeked) < size:
+            chunk = self._file.read(size - len(self._peeked))
+
+            if not chunk:
+                break
+
+            self._peeked += chunk
+
+        return self._peeked[:size]
+
+    def readinto(self, buffer: Any) -> int:
+        if self._peeked:
+            data = self._peeked[: len(buffer)]
+            self._peeked = self._peeked[len(data) :]
+        else:
+            data = self._file.read(len(buffer))
+
+        buffer[: len(data)] = data
+        self._progress_bar.update(len(data))
+
+        return len(data)
+
+
+def _get_compression(header: bytes) -> Optional[str]:
+    for magic, compression in COMPRESSION_MAGICS.items():
+        if header.startswith(magic):
+            return compression
 
+    return None
+
+
+def _open_decompressed(file: BinaryIO, compression: Optional[str]) -> BinaryIO:
+    if compression is None:
+        return file
+    elif compression == "gz":
+        return cast(BinaryIO, gzip.GzipFile(fileobj=file, mode="rb"))
+    elif compression == "bz2":
+        return cast(BinaryIO, bz2.BZ2File(file, mode="rb"))
+    elif compression == "xz":
+        return cast(BinaryIO, lzma.LZMAFile(file, mode="rb"))
+    elif compression == "zst":
+        if zstandard is None:
+            raise Exception(
+                "the zstandard package must be installed to extract zstd files (extra: zstd)"
+            )
+
+        return cast(BinaryIO, zstandard.ZstdDecompressor().stream_reader(file))
+    else:
+        raise Exception(f"unsupported compression: {compression!r}")
+
+
+def _extract_stream(
+    reader: _ProgressReader, name: str, extract_dir: Union[str, pathlib.Path]
+) -> List[str]:
+    """
+    Extracts a tar archive or compressed file from ``reader`` in a single pass and
+    returns the top-level paths of what was extracted. ``name`` is the file name of the
+    archive, which determines whether it's a tar archive and the name of the output
+    file if it's a single compressed file.
+    """
+
+    compression = _get_compression(reader.peek(max(map(len, COMPRESSION_MAGICS))))
+    stream = _open_decompressed(cast(BinaryIO, reader), compression)
+    name_lower = name.lower()
+
+    if name_lower.endswith(TAR_SUFFIXES):
+        member_names: List[str] = []
+
+        with tarfile.open(fileobj=stream, mode="r|") as tar_file:
+            for member in tar_file:
+                member_names.append(member.name)
+                extracted_path = pathlib.Path(extract_dir, member.name)
+
+                # Members that aren't read are skipped over in the stream
                 if (
-                    not extracted_path.exists()
-                    or extracted_path.stat().st_size != file.file_size
+                    member.isfile()
+                    and extracted_path.exists()
+                    and extracted_path.stat().st_size == member.size
                 ):
-                    zip_file.extract(file, extract_dir)
+                    continue
 
-                progress_bar.update(file.file_size)
+                if hasattr(tarfile, "data_filter"):
+                    tar_file.extract(member, extract_dir, filter="data")
+                else:
+                    tar_file.extract(member, extract_dir)
 
-        progress_bar.close()
+        return _get_top_level_paths(member_names)
+    elif compression is not None:
+        suffix = COMPRESSION_SUFFIXES[compression]
 
-    print("  Extraction complete.")
+        if not name_lower.endswith(suffix):
+            raise Exception(
+                f"compressed file name does not end with {suffix!r} (name: {name!r})"
+            )
+
+        output_path = pathlib.Path(extract_dir, name[: -len(suffix)])
+        output_path_temp = pathlib.Path(f"{output_path}.tmp")
+
+        os.makedirs(extract_dir, exist_ok=True)
+
+        with open(output_path_temp, "wb") as file:
+            shutil.copyfileobj(stream, file, CHUNK_SIZE)
+
+        os.replace(output_path_temp, output_path)
+
+        return [output_path.name]
+    else:
+        raise Exception(f"unsupported archive format (name: {name!r})")
+
+
+def _get_top_level_paths(member_names: Iterable[str]) -> List[str]:
+    return sorted(
+        {
+            pathlib.PurePosixPath(member_name).parts[0]
+            for member_name in member_names
+            if len(pathlib.PurePosixPath(member_name).parts) > 0
+        }
+    )
+
+
+def _are_top_level_paths_present(
+    extract_dir: Union[str, pathlib.Path], manifest: Dict[str, Any]
+) -> bool:
+    """
+    Cheaply checks that the extracted files weren't deleted since the manifest was
+    written, which would leave the manifest behind. Manifests written before the
+    top-level paths were recorded never pass.
+    """
+
+    top_level_paths = manifest.get("top_level_paths")
+
+    return top_level_paths is not None and all(
+        pathlib.Path(extract_dir, path).exists() for path in top_level_paths
+    )
+
+
+def _get_manifest_path(
+    archive_path: Union[str, pathlib.Path], extract_dir: Union[str, pathlib.Path]
+) -> pathlib.Path:
+    return pathlib.Path(extract_dir, f".{pathlib.Path(archive_path).name}.extract.json")
+
+
+def _read_manifest(
+    archive_path: Union[str, pathlib.Path], extract_dir: Union[str, pathlib.Path]
+) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_get_manifest_path(archive_path, extract_dir), "r") as file:
+            return cast(Dict[str, Any], json.load(file))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(
+    archive_path: Union[str, pathlib.Path],
+    extract_dir: Union[str, pathlib.Path],
+    manifest: Dict[str, Any],
+) -> None:
+    manifest_path = _get_manifest_path(archive_path, extract_dir)
+    manifest_path_temp = pathlib.Path(f"{manifest_path}.tmp")
+
+    os.makedirs(extract_dir, exist_ok=True)
+
+    with open(manifest_path_temp, "w") as file:
+        json.dump(manifest, file)
+
+    os.replace(manifest_path_temp, manifest_path)
+
+
+def _get_archive_identity(
+    archive_path: Union[str, pathlib.Path], sha256: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Gets the size, modification time and SHA-256 of the archive. The archive is only
+    hashed if ``sha256`` isn't given.
+    """
+
+    stat = pathlib.Path(archive_path).stat()
+
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": _hash_file(archive_path) if sha256 is None else sha256,
+    }
+
+
+def _is_archive_unchanged(
+    archive_path: Union[str, pathlib.Path], identity: Dict[str, Any]
+) -> bool:
+    """
+    Checks whether the archive still matches ``identity``. The archive is only hashed
+    if it has the same size but a different modification time, such as when the same
+    file was downloaded again.
+    """
+
+    stat = pathlib.Path(archive_path).stat()
+
+    if stat.st_size != identity["size"]:
+        return False
+
+    if stat.st_mtime_ns == identity["mtime_ns"]:
+        return True
+
+    sha256: str = identity["sha256"]
+
+    return _hash_file(archive_path) == sha256
+
+
+def _hash_file(path: Union[str, pathlib.Path]) -> str:
+    hash = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            hash.update(chunk)
+
+    return hash.hexdigest()
+
+
+def _crc_file(path: pathlib.Path) -> int:
+    result = 0
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            result = zlib.crc32(chunk, result)
+
+    return result
+
+
+def _is_extracted(
+    extract_dir: Union[str, pathlib.Path],
+    file: zipfile.ZipInfo,
+    extracted_crc: Optional[int],
+) -> bool:
+    """
+    Checks whether ``file`` has already been extracted. ``extracted_crc`` is the CRC of
+    the member the last time the archive was extracted, if known, in which case the
+    extracted file is trusted to still have that content.
+    """
+
+    extracted_path = _get_extracted_path(extract_dir, file)
+
+    if not extracted_path.exists() or extracted_path.stat().st_size != file.file_size:
+        return False
+
+    if extracted_crc is not None:
+        return extracted_crc == file.CRC
+
+    return _crc_file(extracted_path) == file.CRC
+
+
+def _get_extracted_path(
+    extract_dir: Union[str, pathlib.Path], file: zipfile.ZipInfo
+) -> pathlib.Path:
+    """
+    Gets the path that ``ZipFile.extract`` writes ``file`` to, which drops drive
+    letters, empty components, ``.`` and ``..`` from the member name.
+    """
+
+    name = file.filename.replace("/", os.path.sep)
+
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+
+    parts = [
+        part
+        for part in os.path.splitdrive(name)[1].split(os.path.sep)
+        if part not in ("", os.path.curdir, os.path.pardir)
+    ]
+
+    return pathlib.Path(extract_dir, *parts)
+
+
+def _split_members(
+    members: List[zipfile.ZipInfo], count: int
+) -> List[List[zipfile.ZipInfo]]:
+    """
+    Splits ``members`` into at most ``count`` batches with roughly equal total
+    compressed sizes, so that each worker gets a similar amount of work.
+    """
+
+    batches: List[List[zipfile.ZipInfo]] = [[] for _ in range(count)]
+    batch_sizes = [0] * count
+
+    for file in sorted(members, key=lambda file: file.compress_size, reverse=True):
+        index = batch_sizes.index(min(batch_sizes))
+        batches[index].append(file)
+        batch_sizes[index] += file.compress_size
+
+    return [batch for batch in batches if batch]
+
+
+def _extract_members(
+    zip_file: zipfile.ZipFile,
+    extract_dir: Union[str, pathlib.Path],
+    members: List[zipfile.ZipInfo],
+    progress_bar: tqdm,
+) -> None:
+    for file in members:
+        zip_file.extract(file, extract_dir)
+        progress_bar.update(file.file_size)
+
+
+def _extract_members_from_path(
+    archive_path: Union[str, pathlib.Path],
+    extract_dir: Union[str, pathlib.Path],
+    members: List[zipfile.ZipInfo],
+    progress_bar: tqdm,
+) -> None:
+    with zipfile.ZipFile(archive_path, "r") as zip_file:
+        _extract_members(zip_file, extract_dir, members, progress_bar)
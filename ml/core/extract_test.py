@@ -13,7 +13,19 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
+from typing import Iterator
+import bz2
+import contextlib
+import functools
+import http.server
+import io
 import os
+import pathlib
+import pytest
+import shutil
+import tarfile
+import threading
+import zipfile
 from . import extract
 from . import repo_paths
 from . import download
@@ -40,3 +52,180 @@ def test_extract_archive() -> None:
     assert os.path.exists(extract_dir / "data")
     assert os.path.exists(extract_dir / "data/names")
     assert os.path.exists(extract_dir / "data/names/Arabic.txt")
+
+
+def _make_archive(archive_path: pathlib.Path) -> None:
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for i in range(100):
+            zip_file.writestr(f"data/{i % 7}/file_{i}.txt", f"{i}\n" * i)
+
+
+def test_extract_archive_workers(tmp_path: pathlib.Path) -> None:
+    archive_path = tmp_path / "data.zip"
+    _make_archive(archive_path)
+
+    extract.extract_archive(archive_path, tmp_path / "serial")
+    extract.extract_archive(archive_path, tmp_path / "parallel", workers=4)
+
+    for i in range(100):
+        expected = f"{i}\n" * i
+        assert (tmp_path / f"serial/data/{i % 7}/file_{i}.txt").read_text() == expected
+        assert (
+            tmp_path / f"parallel/data/{i % 7}/file_{i}.txt"
+        ).read_text() == expected
+
+
+def test_split_members(tmp_path: pathlib.Path) -> None:
+    archive_path = tmp_path / "data.zip"
+    _make_archive(archive_path)
+
+    with zipfile.ZipFile(archive_path, "r") as zip_file:
+        batches = extract._split_members(zip_file.infolist(), 4)
+
+        assert len(batches) == 4
+        assert sorted(file.filename for batch in batches for file in batch) == sorted(
+            zip_file.namelist()
+        )
+
+
+def test_extract_archive_manifest(tmp_path: pathlib.Path) -> None:
+    archive_path = tmp_path / "data.zip"
+    _make_archive(archive_path)
+
+    extract_dir = tmp_path / "extracted"
+    extract.extract_archive(archive_path, extract_dir)
+
+    # Unchanged archive: members aren't looked at, even if they were modified
+    (extract_dir / "data/1/file_1.txt").write_text("X\n")
+    extract.extract_archive(archive_path, extract_dir)
+    assert (extract_dir / "data/1/file_1.txt").read_text() == "X\n"
+
+    # Verifying catches the same-size modification by CRC
+    extract.extract_archive(archive_path, extract_dir, verify=True)
+    assert (extract_dir / "data/1/file_1.txt").read_text() == "1\n"
+
+
+def test_extract_archive_deleted(tmp_path: pathlib.Path) -> None:
+    archive_path = tmp_path / "data.zip"
+    _make_archive(archive_path)
+
+    extract_dir = tmp_path / "extracted"
+    extract.extract_archive(archive_path, extract_dir)
+
+    # The manifest is left behind when the extracted files are deleted
+    shutil.rmtree(extract_dir / "data")
+    extract.extract_archive(archive_path, extract_dir)
+    assert (extract_dir / "data/1/file_1.txt").read_text() == "1\n"
+
+    tar_path = tmp_path / "data.tar"
+    _make_tar_archive(tar_path, "w")
+
+    extract.extract_archive(tar_path, tmp_path / "extracted_tar")
+    shutil.rmtree(tmp_path / "extracted_tar/data")
+    extract.extract_archive(tar_path, tmp_path / "extracted_tar")
+    assert (tmp_path / "extracted_tar/data/1/file_1.txt").read_text() == "1\n"
+
+
+def test_extract_archive_changed(tmp_path: pathlib.Path) -> None:
+    archive_path = tmp_path / "data.zip"
+    _make_archive(archive_path)
+
+    extract_dir = tmp_path / "extracted"
+    extract.extract_archive(archive_path, extract_dir)
+
+    # Same size, different content
+    with zipfile.ZipFile(archive_path, "w") as zip_file:
+        zip_file.writestr("data/1/file_1.txt", "2\n")
+
+    extract.extract_archive(archive_path, extract_dir)
+    assert (extract_dir / "data/1/file_1.txt").read_text() == "2\n"
+
+
+def _make_tar_archive(archive_path: pathlib.Path, mode: str) -> None:
+    with tarfile.open(archive_path, mode) as tar_file:  # type: ignore
+        for i in range(20):
+            content = (f"{i}\n" * i).encode("utf-8")
+            info = tarfile.TarInfo(f"data/{i % 7}/file_{i}.txt")
+            info.size = len(content)
+            tar_file.addfile(info, io.BytesIO(content))
+
+
+@contextlib.contextmanager
+def _serve_dir(path: pathlib.Path) -> Iterator[str]:
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(Handler, directory=str(path))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize(
+    "name,mode",
+    [
+        ("data.tar", "w"),
+        ("data.tar.gz", "w:gz"),
+        ("data.tbz2", "w:bz2"),
+        ("data.tar.xz", "w:xz"),
+    ],
+)
+def test_extract_archive_tar(tmp_path: pathlib.Path, name: str, mode: str) -> None:
+    archive_path = tmp_path / name
+    _make_tar_archive(archive_path, mode)
+
+    extract.extract_archive(archive_path, tmp_path / "extracted")
+
+    for i in range(20):
+        assert (
+            tmp_path / f"extracted/data/{i % 7}/file_{i}.txt"
+        ).read_text() == f"{i}\n" * i
+
+
+def test_extract_archive_compressed_file(tmp_path: pathlib.Path) -> None:
+    archive_path = tmp_path / "names.txt.bz2"
+    archive_path.write_bytes(bz2.compress(b"Ada\nGrace\n"))
+
+    extract.extract_archive(archive_path, tmp_path / "extracted")
+
+    assert (tmp_path / "extracted/names.txt").read_text() == "Ada\nGrace\n"
+
+
+def test_extract_http(tmp_path: pathlib.Path) -> None:
+    _make_tar_archive(tmp_path / "data.tar.gz", "w:gz")
+    _make_archive(tmp_path / "data.zip")
+
+    with _serve_dir(tmp_path) as url:
+        extract.extract_http(f"{url}/data.tar.gz", tmp_path / "extracted")
+
+        with pytest.raises(Exception):
+            extract.extract_http(f"{url}/data.zip", tmp_path / "extracted_zip")
+
+    for i in range(20):
+        assert (
+            tmp_path / f"extracted/data/{i % 7}/file_{i}.txt"
+        ).read_text() == f"{i}\n" * i
+
+
+def test_open_archive(tmp_path: pathlib.Path) -> None:
+    archive_path = tmp_path / "data.zip"
+    _make_archive(archive_path)
+
+    with extract.open_archive(archive_path, "data/3/") as root:
+        assert sorted(path.name for path in root.iterdir()) == sorted(
+            f"file_{i}.txt" for i in range(3, 100, 7)
+        )
+        assert (root / "file_10.txt").read_text() == "10\n" * 10
+
+    assert not (tmp_path / "data").exists()
+
+    # The archive and its map are closed on exit
+    assert root.root.fp is None
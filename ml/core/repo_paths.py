@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
+import functools
 import pathlib
 import os
 from typing import Optional
@@ -20,37 +21,33 @@ import re
 
 _PROJECT_NAME_PATTERN = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*")
 
+# If set, this is used as the repository root without searching for it
+REPO_ROOT_ENV_VAR = "ML_REPO_ROOT"
 
-def _is_git_repo(path: pathlib.Path) -> bool:
-    if not path.is_dir():
-        return False
+# If set, artifacts are stored here instead of in the repository, for example to put
+# them on faster local storage. No repository is needed to find artifact paths then.
+ARTIFACTS_ROOT_ENV_VAR = "ML_ARTIFACTS_ROOT"
 
-    for child in path.iterdir():
-        if child.name == ".git":
-            return True
+_README_MARKER = "Sophie's ML Monorepo"
 
-    return False
+
+def _is_git_repo(path: pathlib.Path) -> bool:
+    return (path / ".git").exists()
 
 
 def _is_ml_repo(path: pathlib.Path) -> bool:
-    if not path.is_dir():
+    if not (path / "ml").is_dir() or not (path / ".vscode").is_dir():
         return False
 
-    has_core = False
-    has_dot_vscode = False
-    has_readme = False
-
     for child in path.iterdir():
-        if child.name == "ml":
-            has_core = True
-        elif child.name == ".vscode":
-            has_dot_vscode = True
-        elif child.name.lower() == "readme.md":
+        if child.name.lower() == "readme.md":
             with open(child, "r") as file:
-                if "Sophie's ML Monorepo" in file.read():
-                    has_readme = True
+                # The marker is in the title, so there's no need to read the rest
+                for line in file:
+                    if _README_MARKER in line:
+                        return True
 
-    return has_core and has_dot_vscode and has_readme
+    return False
 
 
 def _validate_project_name(project_name: str) -> None:
@@ -67,15 +64,12 @@ def _optionally_create_and_return(path: pathlib.Path, create: bool) -> pathlib.P
     return path
 
 
-def get_repo_root_path(
-    cwd: Optional[pathlib.Path] = None, create: bool = False
-) -> pathlib.Path:
-    start: pathlib.Path
-
-    if cwd is None:
-        start = pathlib.Path(os.getcwd())
-    else:
-        start = cwd
+@functools.lru_cache(maxsize=None)
+def _find_repo_root_path(start: pathlib.Path) -> pathlib.Path:
+    """
+    Searches ``start`` and its parents for the repository root. Results are cached per
+    ``start`` since the data pipeline resolves paths many times per load.
+    """
 
     result = start
 
@@ -92,7 +86,49 @@ def get_repo_root_path(
             f'Git repository found in cwd or parent directories does not contain expected children (required: .vscode/, core/, README.md containing "Sophie\'s ML Monorepo", cwd: {start})'
         )
 
-    return _optionally_create_and_return(result, create)
+    return result
+
+
+def get_repo_root_path(
+    cwd: Optional[pathlib.Path] = None, create: bool = False
+) -> pathlib.Path:
+    """
+    Gets the root of the repository containing ``cwd``, or the current working directory
+    if not given.
+
+    If the ``ML_REPO_ROOT`` environment variable is set, it's used as the root without
+    searching.
+    """
+
+    override = os.environ.get(REPO_ROOT_ENV_VAR)
+
+    if override:
+        return _optionally_create_and_return(pathlib.Path(override), create)
+
+    start: pathlib.Path
+
+    if cwd is None:
+        start = pathlib.Path(os.getcwd())
+    else:
+        start = cwd
+
+    return _optionally_create_and_return(_find_repo_root_path(start), create)
+
+
+def get_dir_artifacts(
+    cwd: Optional[pathlib.Path] = None, create: bool = False
+) -> pathlib.Path:
+    """
+    Gets the root directory for artifacts, which is ``artifacts`` in the repository
+    unless overridden with the ``ML_ARTIFACTS_ROOT`` environment variable.
+    """
+
+    override = os.environ.get(ARTIFACTS_ROOT_ENV_VAR)
+
+    if override:
+        return _optionally_create_and_return(pathlib.Path(override), create)
+
+    return _optionally_create_and_return(get_repo_root_path(cwd) / "artifacts", create)
 
 
 def get_dir_artifacts_data_raw(
@@ -101,7 +137,7 @@ def get_dir_artifacts_data_raw(
     _validate_project_name(project_name)
 
     return _optionally_create_and_return(
-        get_repo_root_path(cwd) / "artifacts" / "data" / project_name / "raw", create
+        get_dir_artifacts(cwd) / "data" / project_name / "raw", create
     )
 
 
@@ -111,7 +147,7 @@ def get_dir_artifacts_data_intermediate(
     _validate_project_name(project_name)
 
     return _optionally_create_and_return(
-        get_repo_root_path(cwd) / "artifacts" / "data" / project_name / "intermediate",
+        get_dir_artifacts(cwd) / "data" / project_name / "intermediate",
         create,
     )
 
@@ -122,17 +158,23 @@ def get_dir_artifacts_data_cache(
     _validate_project_name(project_name)
 
     return _optionally_create_and_return(
-        get_repo_root_path(cwd) / "artifacts" / "data" / project_name / "cache", create
+        get_dir_artifacts(cwd) / "data" / project_name / "cache", create
     )
 
 
+def get_dir_artifacts_downloads(
+    cwd: Optional[pathlib.Path] = None, create: bool = False
+) -> pathlib.Path:
+    return _optionally_create_and_return(get_dir_artifacts(cwd) / "downloads", create)
+
+
 def get_dir_checkpoints(
     project_name: str, cwd: Optional[pathlib.Path] = None, create: bool = False
 ) -> pathlib.Path:
     _validate_project_name(project_name)
 
     return _optionally_create_and_return(
-        get_repo_root_path(cwd) / "artifacts" / "checkpoints" / project_name, create
+        get_dir_artifacts(cwd) / "checkpoints" / project_name, create
     )
 
 
@@ -142,5 +184,5 @@ def get_dir_models(
     _validate_project_name(project_name)
 
     return _optionally_create_and_return(
-        get_repo_root_path(cwd) / "artifacts" / "models" / project_name, create
+        get_dir_artifacts(cwd) / "models" / project_name, create
     )
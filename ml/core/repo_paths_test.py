@@ -26,3 +26,26 @@ def test_get_repo_root_path_good() -> None:
 def test_get_repo_root_path_bad() -> None:
     with pytest.raises(Exception):
         get_repo_root_path(pathlib.Path.home())
+
+
+def test_get_repo_root_path_cached() -> None:
+    assert get_repo_root_path() is get_repo_root_path()
+
+
+def test_get_repo_root_path_env(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path
+) -> None:
+    monkeypatch.setenv(REPO_ROOT_ENV_VAR, str(tmp_path))
+
+    assert get_repo_root_path(pathlib.Path.home()) == tmp_path
+    assert get_dir_models("example") == tmp_path / "artifacts" / "models" / "example"
+
+
+def test_get_dir_artifacts_env(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path
+) -> None:
+    monkeypatch.setenv(ARTIFACTS_ROOT_ENV_VAR, str(tmp_path))
+
+    assert get_dir_artifacts_data_raw("example", pathlib.Path.home()) == (
+        tmp_path / "data" / "example" / "raw"
+    )
@@ -14,7 +14,7 @@
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
 import abc
-from typing import Optional, Generic, TypeVar, Tuple
+from typing import List, Optional, Generic, Sequence, TypeVar, Tuple
 
 State = TypeVar("State")
 Input = TypeVar("Input")
@@ -136,3 +136,70 @@ class SimulationBase(abc.ABC, Generic[State, Input, Output]):
         updated state.
         """
         pass
+
+    def step_batch(
+        self,
+        states: Optional[Sequence[Optional[State]]] = None,
+        inputs: Optional[Sequence[Optional[Input]]] = None,
+        count: Optional[int] = None,
+    ) -> Tuple[Sequence[Output], Optional[Sequence[Optional[State]]]]:
+        """
+        Runs ``step`` for a batch of states and inputs, where the ``i``-th output is
+        ``step(states[i], inputs[i])``.
+
+        The default implementation calls ``step`` once per element. Simulations whose
+        outputs are arrays should override this with a vectorized implementation which
+        returns all of the outputs stacked into a single array of shape ``(N, ...)``,
+        which can be indexed and measured the same way as a list of outputs.
+
+        Parameters
+        ----------
+        states: Optional[Sequence[Optional[State]]]
+            The current state for each element of the batch, or ``None`` if the
+            simulation has no state.
+        inputs: Optional[Sequence[Optional[Input]]]
+            The input for each element of the batch, or ``None`` if the simulation has
+            no input.
+        count: Optional[int]
+            The size of the batch. Only required if both ``states`` and ``inputs`` are
+            ``None``.
+
+        Returns
+        -------
+        A tuple containing the outputs and, if ``states`` was given, the updated
+        states.
+        """
+
+        batch_size = _get_batch_size(states, inputs, count)
+
+        outputs: List[Output] = []
+        states_next: List[Optional[State]] = []
+
+        for i in range(batch_size):
+            output, state_next = self.step(
+                None if states is None else states[i],
+                None if inputs is None else inputs[i],
+            )
+
+            outputs.append(output)
+            states_next.append(state_next)
+
+        return outputs, None if states is None else states_next
+
+
+def _get_batch_size(
+    states: Optional[Sequence[object]],
+    inputs: Optional[Sequence[object]],
+    count: Optional[int],
+) -> int:
+    sizes = {len(batch) for batch in (states, inputs) if batch is not None}
+
+    if count is not None:
+        sizes.add(count)
+
+    if len(sizes) != 1:
+        raise Exception(
+            f"batch size must be given by exactly one of states, inputs, or count, or they must agree (sizes: {sorted(sizes)})"
+        )
+
+    return sizes.pop()
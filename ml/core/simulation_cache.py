@@ -0,0 +1,559 @@
+# Copyright (c) 2023 Sophie Katz
+#
+# This file is part of Sophie's ML Monorepo.
+#
+# Sophie's ML Monorepo is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Sophie's ML Monorepo is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Sophie's
+# ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
+
+from .repo_paths import get_dir_artifacts_data_cache
+from .simulation import _get_batch_size, Input, SimulationBase, State
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, List, Optional, Sequence, TextIO, Tuple, Union
+import dataclasses
+import hashlib
+import json
+import mmap
+import numpy as np
+import numpy.typing as npt
+import os
+import pathlib
+import pickle
+import uuid
+
+# The default limit on the total size of the cached outputs in bytes
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# The default size in bytes at which a shard is full and a new one is started
+DEFAULT_SHARD_BYTES = 64 * 1024 * 1024
+
+# Outputs are appended to shards stored as ``<cache_dir>/<shard name>.bin``, each with
+# an index in ``<cache_dir>/<shard name>.index`` which has a JSON line of
+# ``[key, offset, dtype, shape]`` for each output
+SHARD_SUFFIX = ".bin"
+INDEX_SUFFIX = ".index"
+
+# Outputs are stored at offsets in their shard which are multiples of this
+ALIGNMENT = 64
+
+
+@dataclasses.dataclass(frozen=True)
+class _Entry:
+    shard_name: str
+    offset: int
+    dtype: np.dtype[Any]
+    shape: Tuple[int, ...]
+    size: int
+
+
+@dataclasses.dataclass
+class _Shard:
+    size: int
+    keys: List[str]
+
+
+class CachedSimulation(SimulationBase[State, Input, npt.NDArray[Any]]):
+    """
+    Wraps a simulation whose outputs are arrays, caching them on disk keyed on a hash of
+    the simulation's configuration, the state and the input. Since simulations are
+    deterministic, repeating a step reads its output back memory-mapped instead of
+    generating it again.
+
+    Outputs are appended to shard files, which are memory-mapped once each, and found
+    with an index kept in memory. When the total size of the shards goes over
+    ``max_bytes``, the least recently used shard is deleted along with all of the
+    outputs in it. Shards written by other processes sharing the cache directory are
+    only seen by instances created after them, so the limit is approximate then.
+
+    The outputs of a batch generated by ``step_batch`` are kept together in one shard,
+    so repeating the batch returns a view of the shard without copying anything.
+
+    Each hit still hashes the input, so the cache only pays off for simulations whose
+    steps take longer than that, which isn't the case for tiny images.
+
+    Only outputs are cached, so the simulation's ``step`` must not return a state.
+
+    Outputs read from the cache are read-only memory-mapped arrays.
+
+    Parameters
+    ----------
+    simulation: SimulationBase[State, Input, npt.NDArray[Any]]
+        The simulation to cache the outputs of. Dataclass simulations are identified by
+        their fields which are compared, other simulations by their attributes whose
+        names don't start with an underscore. The configuration is read once, so the
+        simulation shouldn't be changed after wrapping it.
+    cache_dir: Optional[Union[str, pathlib.Path]]
+        The directory to store outputs in. Defaults to a directory for the simulation's
+        class in ``get_dir_artifacts_data_cache``, with the name of the module defining
+        it as the project name.
+    max_bytes: int
+        The limit on the total size of the cached outputs
+    shard_bytes: int
+        The size at which a shard is full. Smaller shards make eviction finer grained.
+    """
+
+    def __init__(
+        self,
+        simulation: SimulationBase[State, Input, npt.NDArray[Any]],
+        cache_dir: Optional[Union[str, pathlib.Path]] = None,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        shard_bytes: int = DEFAULT_SHARD_BYTES,
+    ) -> None:
+        if cache_dir is None:
+            cache_dir = (
+                get_dir_artifacts_data_cache(
+                    type(simulation).__module__.rsplit(".", 1)[-1]
+                )
+                / type(simulation).__name__
+            )
+
+        self.simulation = simulation
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.shard_bytes = shard_bytes
+
+        self._config_hash = _hash_config(simulation)
+
+        self._entries: Dict[str, _Entry] = {}
+        # Shards by name, from least to most recently used
+        self._shards: "OrderedDict[str, _Shard]" = OrderedDict()
+        self._total_bytes = 0
+        self._maps: Dict[str, mmap.mmap] = {}
+
+        # The shard being appended to, which only this instance writes to
+        self._shard_name: Optional[str] = None
+        self._shard_file: Optional[BinaryIO] = None
+        self._index_file: Optional[TextIO] = None
+
+        self._scan()
+
+    def start(self) -> State:
+        return self.simulation.start()
+
+    def step(
+        self, state: Optional[State] = None, input: Optional[Input] = None
+    ) -> Tuple[npt.NDArray[Any], Optional[State]]:
+        key = self._get_key(state, input)
+        output = self._read(key)
+
+        if output is None:
+            output, state_next = self.simulation.step(state, input)
+            _check_state(state_next)
+            _check_output(output)
+            self._reserve(output.nbytes)
+            self._write(key, output)
+
+        return output, None
+
+    def step_batch(  # type: ignore[override]
+        self,
+        states: Optional[Sequence[Optional[State]]] = None,
+        inputs: Optional[Sequence[Optional[Input]]] = None,
+        count: Optional[int] = None,
+    ) -> Tuple[
+        Union[npt.NDArray[Any], List[npt.NDArray[Any]]],
+        Optional[Sequence[Optional[State]]],
+    ]:
+        """
+        Like ``SimulationBase.step_batch``, but only generates the outputs which aren't
+        cached, with a single call to the simulation's ``step_batch``.
+
+        The outputs are returned as a single array if they have the same shape and
+        type.
+        """
+
+        batch_size = _get_batch_size(states, inputs, count)
+
+        keys = [
+            self._get_key(
+                None if states is None else states[i],
+                None if inputs is None else inputs[i],
+            )
+            for i in range(batch_size)
+        ]
+
+        if batch_size > 0:
+            outputs_run = self._read_run(keys)
+
+            if outputs_run is not None:
+                return outputs_run, None if states is None else [None] * batch_size
+
+        outputs: List[Optional[npt.NDArray[Any]]] = [self._read(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+
+        if len(missing) > 0:
+            missing_outputs, missing_states = self.simulation.step_batch(
+                None if states is None else [states[i] for i in missing],
+                None if inputs is None else _take(inputs, missing),
+                len(missing),
+            )
+
+            for state_next in missing_states or []:
+                _check_state(state_next)
+
+            for output in missing_outputs:
+                _check_output(output)
+
+            # Keep the batch in one shard so that it can be read back without copying
+            self._reserve(
+                sum(
+                    -(-output.nbytes // ALIGNMENT) * ALIGNMENT
+                    for output in missing_outputs
+                )
+            )
+
+            for i, output in zip(missing, missing_outputs):
+                self._write(keys[i], output)
+                outputs[i] = output
+
+            # Nothing was cached, so the simulation's outputs are already stacked
+            if len(missing) == batch_size and isinstance(missing_outputs, np.ndarray):
+                return missing_outputs, None if states is None else [None] * batch_size
+
+        outputs_present = [output for output in outputs if output is not None]
+
+        if len({(output.shape, output.dtype) for output in outputs_present}) == 1:
+            outputs_stacked: Union[npt.NDArray[Any], List[npt.NDArray[Any]]] = np.stack(
+                outputs_present
+            )
+        else:
+            outputs_stacked = outputs_present
+
+        return outputs_stacked, None if states is None else [None] * batch_size
+
+    def clear(self) -> None:
+        """
+        Deletes all of the cached outputs.
+        """
+
+        while len(self._shards) > 0:
+            self._evict()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Open files and maps can't be pickled, so a copy starts a shard of its own
+        state = self.__dict__.copy()
+        state.update(_maps={}, _shard_name=None, _shard_file=None, _index_file=None)
+
+        return state
+
+    def _get_key(self, state: Optional[State], input: Optional[Input]) -> str:
+        hasher = hashlib.sha256(self._config_hash)
+        _update_hash(hasher, state)
+        _update_hash(hasher, input)
+
+        return hasher.hexdigest()
+
+    def _get_shard_path(self, shard_name: str) -> pathlib.Path:
+        return self.cache_dir / f"{shard_name}{SHARD_SUFFIX}"
+
+    def _get_index_path(self, shard_name: str) -> pathlib.Path:
+        return self.cache_dir / f"{shard_name}{INDEX_SUFFIX}"
+
+    def _scan(self) -> None:
+        """
+        Reads the indexes of the shards which are already cached, ordered by when they
+        were last written to.
+        """
+
+        shards: List[Tuple[int, str, int]] = []
+
+        if self.cache_dir.is_dir():
+            for dir_entry in os.scandir(self.cache_dir):
+                if dir_entry.name.endswith(SHARD_SUFFIX):
+                    stat = dir_entry.stat()
+                    shards.append(
+                        (
+                            stat.st_mtime_ns,
+                            dir_entry.name[: -len(SHARD_SUFFIX)],
+                            stat.st_size,
+                        )
+                    )
+
+        for _, shard_name, size in sorted(shards):
+            keys: List[str] = []
+
+            try:
+                with open(self._get_index_path(shard_name), "r") as file:
+                    lines = file.readlines()
+            except FileNotFoundError:
+                lines = []
+
+            for line in lines:
+                try:
+                    key, offset, dtype, shape = json.loads(line)
+                except ValueError:
+                    # Partly written by a process which was interrupted
+                    continue
+
+                entry = _make_entry(shard_name, offset, np.dtype(dtype), tuple(shape))
+
+                if entry.offset + entry.size <= size:
+                    self._entries[key] = entry
+                    keys.append(key)
+
+            self._shards[shard_name] = _Shard(size, keys)
+            self._total_bytes += size
+
+    def _read(self, key: str) -> Optional[npt.NDArray[Any]]:
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        if entry.size == 0:
+            return np.empty(entry.shape, dtype=entry.dtype)
+
+        shard_map = self._get_map(entry.shard_name, entry.offset + entry.size)
+
+        if shard_map is None:
+            return None
+
+        return np.ndarray(
+            entry.shape, dtype=entry.dtype, buffer=shard_map, offset=entry.offset
+        )
+
+    def _read_run(self, keys: List[str]) -> Optional[npt.NDArray[Any]]:
+        """
+        Reads the outputs for ``keys`` as a single array without copying them if they
+        were written one after another to the same shard, like a batch is. Returns
+        ``None`` otherwise.
+        """
+
+        entries = [self._entries.get(key) for key in keys]
+        first = entries[0]
+
+        if first is None or first.size == 0:
+            return None
+
+        stride = -(-first.size // ALIGNMENT) * ALIGNMENT
+
+        for index, entry in enumerate(entries):
+            if (
+                entry is None
+                or entry.shard_name != first.shard_name
+                or entry.offset != first.offset + index * stride
+                or entry.dtype != first.dtype
+                or entry.shape != first.shape
+            ):
+                return None
+
+        shard_map = self._get_map(first.shard_name, first.offset + len(keys) * stride)
+
+        if shard_map is None:
+            return None
+
+        item = np.ndarray(first.shape, dtype=first.dtype)
+
+        return np.ndarray(
+            (len(keys), *first.shape),
+            dtype=first.dtype,
+            buffer=shard_map,
+            offset=first.offset,
+            strides=(stride, *item.strides),
+        )
+
+    def _get_map(self, shard_name: str, end: int) -> Optional[mmap.mmap]:
+        """
+        Gets a read-only memory map of a shard which is at least ``end`` bytes long and
+        marks the shard as recently used. Returns ``None`` if the shard was deleted.
+        """
+
+        shard_map = self._maps.get(shard_name)
+
+        # Shards which are still being written to are mapped again once they've grown
+        # past the end of the map
+        if shard_map is None or len(shard_map) < end:
+            try:
+                with open(self._get_shard_path(shard_name), "rb") as file:
+                    shard_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                # Deleted by another process
+                self._remove_shard(shard_name)
+                return None
+
+            self._maps[shard_name] = shard_map
+
+        self._shards.move_to_end(shard_name)
+
+        return shard_map
+
+    def _write(self, key: str, output: npt.NDArray[Any]) -> None:
+        """
+        Appends an output to the current shard, which ``_reserve`` must have made room
+        in.
+        """
+
+        assert self._shard_name is not None
+        assert self._shard_file is not None
+        assert self._index_file is not None
+
+        shard = self._shards[self._shard_name]
+        offset = -(-shard.size // ALIGNMENT) * ALIGNMENT
+
+        self._shard_file.write(bytes(offset - shard.size))
+        self._shard_file.write(np.ascontiguousarray(output).data)
+        # The output must be on disk before the index refers to it
+        self._shard_file.flush()
+
+        self._index_file.write(
+            json.dumps([key, offset, output.dtype.str, list(output.shape)]) + "\n"
+        )
+        self._index_file.flush()
+
+        self._total_bytes += offset + output.nbytes - shard.size
+        shard.size = offset + output.nbytes
+        shard.keys.append(key)
+        self._entries[key] = _make_entry(
+            self._shard_name, offset, output.dtype, output.shape
+        )
+        self._shards.move_to_end(self._shard_name)
+
+        while self._total_bytes > self.max_bytes and len(self._shards) > 0:
+            self._evict()
+
+    def _reserve(self, size: int) -> None:
+        """
+        Starts a new shard unless ``size`` more bytes fit in the current one. A shard
+        that's empty takes any size, so a batch reserved at once is never split.
+        """
+
+        if self._shard_name is None or (
+            self._shards[self._shard_name].size > 0
+            and self._shards[self._shard_name].size + size > self.shard_bytes
+        ):
+            self._start_shard()
+
+    def _start_shard(self) -> None:
+        self._close_shard()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Named uniquely so that no two processes ever append to the same shard
+        self._shard_name = uuid.uuid4().hex
+        self._shard_file = open(self._get_shard_path(self._shard_name), "wb")
+        self._index_file = open(self._get_index_path(self._shard_name), "w")
+        self._shards[self._shard_name] = _Shard(0, [])
+
+    def _close_shard(self) -> None:
+        if self._shard_file is not None:
+            self._shard_file.close()
+
+        if self._index_file is not None:
+            self._index_file.close()
+
+        self._shard_name = None
+        self._shard_file = None
+        self._index_file = None
+
+    def _evict(self) -> None:
+        shard_name = next(iter(self._shards))
+        self._remove_shard(shard_name)
+
+        for path in (
+            self._get_shard_path(shard_name),
+            self._get_index_path(shard_name),
+        ):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _remove_shard(self, shard_name: str) -> None:
+        if shard_name == self._shard_name:
+            self._close_shard()
+
+        shard = self._shards.pop(shard_name)
+        self._total_bytes -= shard.size
+        self._maps.pop(shard_name, None)
+
+        for key in shard.keys:
+            entry = self._entries.get(key)
+
+            # The key may have been written again to a later shard
+            if entry is not None and entry.shard_name == shard_name:
+                del self._entries[key]
+
+
+def _make_entry(
+    shard_name: str, offset: int, dtype: np.dtype[Any], shape: Tuple[int, ...]
+) -> _Entry:
+    return _Entry(
+        shard_name, offset, dtype, shape, dtype.itemsize * int(np.prod(shape))
+    )
+
+
+def _check_output(output: object) -> None:
+    if not isinstance(output, np.ndarray) or output.dtype.hasobject:
+        raise Exception(
+            f"only array outputs can be cached (type: {type(output).__name__})"
+        )
+
+
+def _check_state(state: object) -> None:
+    if state is not None:
+        raise Exception(
+            f"only simulations which don't return a state can be cached (state: {state!r})"
+        )
+
+
+def _take(values: Sequence[Any], indices: List[int]) -> Any:
+    if isinstance(values, np.ndarray):
+        return values[indices]
+
+    return [values[i] for i in indices]
+
+
+def _hash_config(simulation: SimulationBase[Any, Any, Any]) -> bytes:
+    hasher = hashlib.sha256()
+    hasher.update(
+        f"{type(simulation).__module__}.{type(simulation).__qualname__}".encode()
+    )
+
+    if dataclasses.is_dataclass(simulation):
+        for field in dataclasses.fields(simulation):
+            if field.compare:
+                hasher.update(field.name.encode())
+                _update_hash(hasher, getattr(simulation, field.name))
+    elif hasattr(simulation, "__dict__"):
+        # Not the repr, which contains the object's address by default and so would
+        # change between runs
+        for name, value in sorted(vars(simulation).items()):
+            if not name.startswith("_"):
+                hasher.update(name.encode())
+                _update_hash(hasher, value)
+    else:
+        raise Exception(
+            f"simulations to cache must be dataclasses or have a __dict__ (type: {type(simulation).__name__})"
+        )
+
+    return hasher.digest()
+
+
+def _update_hash(hasher: "hashlib._Hash", value: object) -> None:
+    """
+    Adds ``value`` to ``hasher``. Values which can be converted to arrays, like nested
+    lists of numbers, hash the same as the equivalent array.
+    """
+
+    if value is None:
+        hasher.update(b"none")
+        return
+
+    try:
+        array = np.asarray(value)
+    except ValueError:
+        array = None
+
+    if array is None or array.dtype.hasobject:
+        hasher.update(b"pickle")
+        hasher.update(pickle.dumps(value))
+    else:
+        hasher.update(f"array {array.dtype.str} {array.shape}".encode())
+        hasher.update(np.ascontiguousarray(array).tobytes())
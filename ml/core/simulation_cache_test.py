@@ -0,0 +1,225 @@
+# Copyright (c) 2023 Sophie Katz
+#
+# This file is part of Sophie's ML Monorepo.
+#
+# Sophie's ML Monorepo is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Sophie's ML Monorepo is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Sophie's
+# ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
+
+from ml.simulations.minelearning_2d_solid import SimulationMineLearning2DSolid
+from typing import Callable, List, Optional, Tuple
+from .simulation import SimulationBase
+from .simulation_cache import CachedSimulation
+import dataclasses
+import numpy as np
+import numpy.typing as npt
+import pathlib
+import pytest
+import time
+
+
+@dataclasses.dataclass
+class _CountingSimulation(SimulationBase[None, int, npt.NDArray[np.int64]]):
+    size: int
+    inputs: List[int] = dataclasses.field(default_factory=list, compare=False)
+
+    def start(self) -> None:
+        pass
+
+    def step(
+        self, state: None = None, input: Optional[int] = None
+    ) -> Tuple[npt.NDArray[np.int64], None]:
+        assert input is not None
+
+        self.inputs.append(input)
+
+        return np.full(self.size, input, dtype=np.int64), None
+
+
+def test_step(tmp_path: pathlib.Path) -> None:
+    simulation = _CountingSimulation(10)
+    cached = CachedSimulation(simulation, tmp_path)
+
+    first, _ = cached.step(input=1)
+    second, _ = cached.step(input=1)
+    third, _ = cached.step(input=2)
+
+    assert (first == 1).all()
+    assert (second == 1).all()
+    assert not second.flags.writeable
+    assert (third == 2).all()
+    assert simulation.inputs == [1, 2]
+
+    # The cache persists between instances
+    CachedSimulation(simulation, tmp_path).step(input=2)
+    assert simulation.inputs == [1, 2]
+
+
+def test_config(tmp_path: pathlib.Path) -> None:
+    CachedSimulation(_CountingSimulation(10), tmp_path).step(input=1)
+
+    simulation = _CountingSimulation(20)
+    output, _ = CachedSimulation(simulation, tmp_path).step(input=1)
+
+    assert output.shape == (20,)
+    assert simulation.inputs == [1]
+
+
+class _PlainSimulation(SimulationBase[None, int, npt.NDArray[np.int64]]):
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._calls = 0
+
+    def start(self) -> None:
+        pass
+
+    def step(
+        self, state: None = None, input: Optional[int] = None
+    ) -> Tuple[npt.NDArray[np.int64], None]:
+        assert input is not None
+
+        self._calls += 1
+
+        return np.full(self.size, input, dtype=np.int64), None
+
+
+def test_config_plain(tmp_path: pathlib.Path) -> None:
+    CachedSimulation(_PlainSimulation(10), tmp_path).step(input=1)
+
+    # Another instance with the same attributes hits the cache
+    simulation = _PlainSimulation(10)
+    CachedSimulation(simulation, tmp_path).step(input=1)
+    assert simulation._calls == 0
+
+    simulation = _PlainSimulation(20)
+    output, _ = CachedSimulation(simulation, tmp_path).step(input=1)
+    assert output.shape == (20,)
+    assert simulation._calls == 1
+
+
+def test_step_batch(tmp_path: pathlib.Path) -> None:
+    simulation = _CountingSimulation(10)
+    cached = CachedSimulation(simulation, tmp_path)
+
+    cached.step(input=2)
+
+    outputs, states = cached.step_batch(inputs=[1, 2, 3])
+
+    assert isinstance(outputs, np.ndarray)
+    assert outputs.shape == (3, 10)
+    assert (outputs[:, 0] == [1, 2, 3]).all()
+    assert states is None
+    assert simulation.inputs == [2, 1, 3]
+
+
+def test_eviction(tmp_path: pathlib.Path) -> None:
+    simulation = _CountingSimulation(1000)
+
+    # Room for two outputs, each in a shard of its own
+    cached = CachedSimulation(
+        simulation, tmp_path, max_bytes=2 * 8000 + 64, shard_bytes=1
+    )
+
+    cached.step(input=1)
+    cached.step(input=2)
+    cached.step(input=1)
+    cached.step(input=3)
+
+    assert len(list(tmp_path.glob("*.bin"))) == 2
+
+    # 2 was the least recently used
+    cached.step(input=1)
+    cached.step(input=3)
+    cached.step(input=2)
+    assert simulation.inputs == [1, 2, 3, 2]
+
+
+def test_shards(tmp_path: pathlib.Path) -> None:
+    simulation = _CountingSimulation(1000)
+    cached = CachedSimulation(simulation, tmp_path, shard_bytes=3 * 8000)
+
+    # The second batch doesn't fit in the first shard, and isn't split across shards
+    cached.step_batch(inputs=[0, 1])
+    cached.step_batch(inputs=[2, 3, 4])
+    assert len(list(tmp_path.glob("*.bin"))) == 2
+
+    # Every output is found again by a new instance, including ones in a shard which
+    # is still being written to
+    outputs, _ = CachedSimulation(simulation, tmp_path).step_batch(inputs=[4, 0, 2])
+    assert isinstance(outputs, np.ndarray)
+    assert (outputs[:, 0] == [4, 0, 2]).all()
+    assert simulation.inputs == [0, 1, 2, 3, 4]
+
+    # Outputs written after a shard was mapped are read from a new map
+    cached.step(input=5)
+    output, _ = cached.step(input=5)
+    assert (output == 5).all()
+    assert simulation.inputs == [0, 1, 2, 3, 4, 5]
+
+
+def test_hit_faster_than_step(tmp_path: pathlib.Path) -> None:
+    simulation = SimulationMineLearning2DSolid(
+        300, 200, 10, [(0xFF, 0x00, 0x00), (0x00, 0xFF, 0x00), (0x00, 0x00, 0xFF)]
+    )
+    cached = CachedSimulation(simulation, tmp_path)
+
+    inputs = np.random.default_rng(0).integers(0, 3, size=(256, 20, 30))
+    cached.step_batch(inputs=inputs)  # type: ignore[arg-type]
+
+    def time_best(function: Callable[[], object]) -> float:
+        times = []
+
+        for _ in range(3):
+            start_time = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start_time)
+
+        return min(times)
+
+    assert time_best(
+        lambda: cached.step_batch(inputs=inputs)  # type: ignore[arg-type]
+    ) < time_best(lambda: simulation.step_batch(inputs=inputs))
+
+
+def test_minelearning(tmp_path: pathlib.Path) -> None:
+    simulation = SimulationMineLearning2DSolid(
+        5, 3, 2, [(0xFF, 0x00, 0x00), (0x00, 0xFF, 0x00), (0x00, 0x00, 0xFF)]
+    )
+    cached = CachedSimulation(simulation, tmp_path)
+
+    inputs = np.random.default_rng(0).integers(0, 3, size=(4, 2, 3))
+
+    expected, _ = simulation.step_batch(inputs=inputs)
+    first, _ = cached.step_batch(inputs=inputs)  # type: ignore[arg-type]
+    second, _ = cached.step_batch(inputs=inputs)  # type: ignore[arg-type]
+
+    assert isinstance(first, np.ndarray)
+    assert isinstance(second, np.ndarray)
+    assert (first == expected).all()
+    assert (second == expected).all()
+
+    # Lists hash the same as arrays
+    output, _ = cached.step(input=inputs[0].tolist())
+    assert not output.flags.writeable
+
+
+def test_state(tmp_path: pathlib.Path) -> None:
+    class StatefulSimulation(SimulationBase[int, None, npt.NDArray[np.int64]]):
+        def start(self) -> int:
+            return 0
+
+        def step(
+            self, state: Optional[int] = None, input: None = None
+        ) -> Tuple[npt.NDArray[np.int64], Optional[int]]:
+            assert state is not None
+            return np.array([state]), state + 1
+
+    with pytest.raises(Exception):
+        CachedSimulation(StatefulSimulation(), tmp_path).step(0)
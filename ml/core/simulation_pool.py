@@ -0,0 +1,468 @@
+# Copyright (c) 2023 Sophie Katz
+#
+# This file is part of Sophie's ML Monorepo.
+#
+# Sophie's ML Monorepo is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Sophie's ML Monorepo is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Sophie's
+# ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
+
+from .simulation import Input, Output, SimulationBase, State
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from types import TracebackType
+from typing import Any, Generic, List, Optional, Sequence, Tuple, Type, Union
+import multiprocessing
+import numpy as np
+import numpy.typing as npt
+import os
+import traceback
+
+# The initial size in bytes of the shared memory block each worker writes its outputs
+# to. Blocks are replaced with larger ones as needed.
+INITIAL_SHARED_MEMORY_SIZE = 64 * 1024
+
+# Outputs sent back from a worker: either ``("array", shape, dtype)`` for an array
+# written to the worker's shared memory block, or ``("objects", outputs)`` for a list
+# of pickled outputs
+_WorkerOutputs = Tuple[Any, ...]
+
+
+class SimulationPool(Generic[State, Input, Output]):
+    """
+    Runs ``count`` copies of a simulation across a pool of worker processes and steps
+    them together, similar to a vectorized environment.
+
+    Each worker holds its own copy of ``simulation`` and steps a contiguous slice of the
+    copies with ``step_batch``. Outputs which are arrays, or lists of arrays with the
+    same shape and type, are written to shared memory instead of being pickled, and are
+    returned as a single array of shape ``(count, ...)``. Other outputs and the states
+    are pickled.
+
+    The simulation must be picklable if the start method isn't ``"fork"``.
+
+    Parameters
+    ----------
+    simulation: SimulationBase[State, Input, Output]
+        The simulation to run copies of
+    count: int
+        The number of copies of the simulation to step at once
+    processes: Optional[int]
+        The number of worker processes. Defaults to the number of CPUs, but never more
+        than ``count``.
+    start_method: Optional[str]
+        The ``multiprocessing`` start method to use, or the platform's default if
+        ``None``
+
+    Example
+    -------
+
+    ```python
+    with SimulationPool(simulation, count=64) as pool:
+        states = pool.start()
+
+        # Step all of the copies and wait for them
+        outputs, states = pool.step(states, inputs)
+
+        # Or step them in the background while doing something else
+        pool.step_async(states, inputs)
+        ...
+        outputs, states = pool.step_wait()
+    ```
+    """
+
+    def __init__(
+        self,
+        simulation: SimulationBase[State, Input, Output],
+        count: int,
+        processes: Optional[int] = None,
+        start_method: Optional[str] = None,
+    ) -> None:
+        if count <= 0:
+            raise Exception(f"count must be positive (count: {count})")
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        self.count = count
+
+        context = multiprocessing.get_context(start_method)
+
+        self._slices = _split_slices(count, min(processes, count))
+        self._connections: List[Connection] = []
+        self._processes: List[multiprocessing.process.BaseProcess] = []
+        self._shared_memories: List[shared_memory.SharedMemory] = []
+        self._waiting = False
+        self._closed = False
+
+        try:
+            for index, (begin, end) in enumerate(self._slices):
+                # The blocks are created and unlinked by this process so that they're
+                # cleaned up even if a worker dies
+                self._shared_memories.append(
+                    shared_memory.SharedMemory(
+                        create=True, size=INITIAL_SHARED_MEMORY_SIZE
+                    )
+                )
+
+                connection, worker_connection = context.Pipe()
+
+                process = context.Process(  # type: ignore[attr-defined]
+                    target=_run_worker,
+                    args=(
+                        simulation,
+                        worker_connection,
+                        self._shared_memories[-1].name,
+                    ),
+                    name=f"SimulationPool-{index}",
+                    daemon=True,
+                )
+                process.start()
+                worker_connection.close()
+
+                self._connections.append(connection)
+                self._processes.append(process)
+        except BaseException:
+            self.close()
+            raise
+
+    def start(self) -> List[State]:
+        """
+        Gets the initial state for every copy of the simulation.
+        """
+
+        self._check_ready()
+
+        for connection, (begin, end) in zip(self._connections, self._slices):
+            connection.send(("start", end - begin))
+
+        states: List[State] = []
+
+        for states_worker in self._receive_all():
+            states.extend(states_worker)
+
+        return states
+
+    def step(
+        self,
+        states: Optional[Sequence[Optional[State]]] = None,
+        inputs: Optional[Sequence[Optional[Input]]] = None,
+    ) -> Tuple[Union[npt.NDArray[Any], List[Output]], Optional[List[Optional[State]]]]:
+        """
+        Steps every copy of the simulation and waits for all of them to finish. The
+        ``i``-th output is ``simulation.step(states[i], inputs[i])``.
+
+        Parameters
+        ----------
+        states: Optional[Sequence[Optional[State]]]
+            The current state of each copy, or ``None`` if the simulation has no state
+        inputs: Optional[Sequence[Optional[Input]]]
+            The input to each copy, or ``None`` if the simulation has no input
+
+        Returns
+        -------
+        A tuple containing the outputs and, if ``states`` was given, the updated
+        states. The outputs are a single array of shape ``(count, ...)`` if the
+        simulation outputs arrays of the same shape and type.
+        """
+
+        self.step_async(states, inputs)
+
+        return self.step_wait()
+
+    def step_async(
+        self,
+        states: Optional[Sequence[Optional[State]]] = None,
+        inputs: Optional[Sequence[Optional[Input]]] = None,
+    ) -> None:
+        """
+        Starts stepping every copy of the simulation without waiting for them to
+        finish. Call ``step_wait`` to get the results.
+
+        See ``step`` for the parameters.
+        """
+
+        self._check_ready()
+
+        for name, batch in (("states", states), ("inputs", inputs)):
+            if batch is not None and len(batch) != self.count:
+                raise Exception(
+                    f"{name} must have one element per copy of the simulation (count: {self.count}, {name}: {len(batch)})"
+                )
+
+        for connection, (begin, end) in zip(self._connections, self._slices):
+            connection.send(
+                (
+                    "step",
+                    None if states is None else states[begin:end],
+                    None if inputs is None else inputs[begin:end],
+                    end - begin,
+                )
+            )
+
+        self._waiting = True
+
+    def step_wait(
+        self,
+    ) -> Tuple[Union[npt.NDArray[Any], List[Output]], Optional[List[Optional[State]]]]:
+        """
+        Waits for the step started by ``step_async`` to finish and returns its results.
+
+        See ``step`` for the return value.
+        """
+
+        if not self._waiting:
+            raise Exception("step_wait was called without calling step_async first")
+
+        self._waiting = False
+
+        results = self._receive_all()
+
+        outputs = self._gather_outputs([outputs for outputs, _ in results])
+
+        if results[0][1] is None:
+            return outputs, None
+
+        states: List[Optional[State]] = []
+
+        for _, states_next in results:
+            states.extend(states_next)
+
+        return outputs, states
+
+    def close(self) -> None:
+        """
+        Stops the worker processes and frees the shared memory.
+        """
+
+        if self._closed:
+            return
+
+        self._closed = True
+
+        for connection in self._connections:
+            try:
+                connection.send(("close",))
+            except (BrokenPipeError, OSError):
+                pass
+
+        for process in self._processes:
+            process.join(timeout=5)
+
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+        for connection in self._connections:
+            connection.close()
+
+        for block in self._shared_memories:
+            block.close()
+            block.unlink()
+
+    def __enter__(self) -> "SimulationPool[State, Input, Output]":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        exc_traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def _check_ready(self) -> None:
+        if self._closed:
+            raise Exception("simulation pool is closed")
+
+        if self._waiting:
+            raise Exception("step_wait must be called before using the pool again")
+
+    def _receive_all(self) -> List[Any]:
+        """
+        Receives the result of the last command sent to every worker. If any of them
+        failed, the first error is raised only after every worker has replied so that
+        no replies are left behind for the next command.
+        """
+
+        results: List[Any] = []
+        error: Optional[Exception] = None
+
+        for index in range(len(self._connections)):
+            try:
+                results.append(self._receive(index))
+            except Exception as exception:
+                if error is None:
+                    error = exception
+
+        if error is not None:
+            raise error
+
+        return results
+
+    def _receive(self, index: int) -> Any:
+        """
+        Receives the result of the last command sent to a worker, replacing its shared
+        memory block with a larger one if it asks for it.
+        """
+
+        while True:
+            try:
+                message = self._connections[index].recv()
+            except EOFError:
+                raise Exception(
+                    f"simulation pool worker exited unexpectedly (worker: {index}, exit code: {self._processes[index].exitcode})"
+                )
+
+            if message[0] == "resize":
+                self._shared_memories[index].close()
+                self._shared_memories[index].unlink()
+                self._shared_memories[index] = shared_memory.SharedMemory(
+                    create=True, size=message[1]
+                )
+                self._connections[index].send(
+                    ("resize", self._shared_memories[index].name)
+                )
+            elif message[0] == "error":
+                raise Exception(
+                    f"simulation raised an exception in worker (worker: {index})\n{message[1]}"
+                )
+            else:
+                return message[1]
+
+    def _gather_outputs(
+        self, worker_outputs: List[_WorkerOutputs]
+    ) -> Union[npt.NDArray[Any], List[Output]]:
+        kinds = {outputs[0] for outputs in worker_outputs}
+        item_types = {
+            (outputs[1][1:], outputs[2])
+            for outputs in worker_outputs
+            if outputs[0] == "array"
+        }
+
+        if kinds == {"array"} and len(item_types) == 1:
+            # Copy every worker's outputs straight into one array
+            item_shape, dtype = item_types.pop()
+            gathered = np.empty((self.count, *item_shape), dtype=dtype)
+
+            for block, (begin, end) in zip(self._shared_memories, self._slices):
+                gathered[begin:end] = np.ndarray(
+                    (end - begin, *item_shape), dtype=dtype, buffer=block.buf
+                )
+
+            return gathered
+
+        gathered_list: List[Output] = []
+
+        for block, outputs in zip(self._shared_memories, worker_outputs):
+            if outputs[0] == "array":
+                shape, dtype = outputs[1], outputs[2]
+                gathered_list.extend(
+                    np.ndarray(shape, dtype=dtype, buffer=block.buf).copy()
+                )
+            else:
+                gathered_list.extend(outputs[1])
+
+        return gathered_list
+
+
+def _split_slices(count: int, parts: int) -> List[Tuple[int, int]]:
+    """
+    Splits ``range(count)`` into ``parts`` contiguous slices whose sizes differ by at
+    most one.
+    """
+
+    size, remainder = divmod(count, parts)
+    slices: List[Tuple[int, int]] = []
+    begin = 0
+
+    for index in range(parts):
+        end = begin + size + (1 if index < remainder else 0)
+        slices.append((begin, end))
+        begin = end
+
+    return slices
+
+
+def _as_array(outputs: Any) -> Optional[npt.NDArray[Any]]:
+    """
+    Gets ``outputs`` as a single array if it's an array already or a list of arrays
+    with the same shape and type.
+    """
+
+    if isinstance(outputs, np.ndarray):
+        return outputs
+
+    if (
+        len(outputs) > 0
+        and all(isinstance(output, np.ndarray) for output in outputs)
+        and len({(output.shape, output.dtype) for output in outputs}) == 1
+    ):
+        return np.stack(outputs)
+
+    return None
+
+
+def _run_worker(
+    simulation: SimulationBase[Any, Any, Any],
+    connection: Connection,
+    shared_memory_name: str,
+) -> None:
+    block = shared_memory.SharedMemory(name=shared_memory_name)
+
+    try:
+        while True:
+            try:
+                command = connection.recv()
+            except EOFError:
+                break
+
+            if command[0] == "close":
+                break
+
+            try:
+                if command[0] == "start":
+                    connection.send(
+                        ("ok", [simulation.start() for _ in range(command[1])])
+                    )
+                    continue
+
+                _, states, inputs, count = command
+
+                outputs, states_next = simulation.step_batch(states, inputs, count)
+                outputs_array = _as_array(outputs)
+
+                if outputs_array is None or outputs_array.dtype.hasobject:
+                    connection.send(("ok", (("objects", list(outputs)), states_next)))
+                    continue
+
+                if outputs_array.nbytes > block.size:
+                    # Ask for a larger block and wait for its name
+                    connection.send(("resize", outputs_array.nbytes))
+                    block.close()
+                    block = shared_memory.SharedMemory(name=connection.recv()[1])
+
+                np.ndarray(
+                    outputs_array.shape, dtype=outputs_array.dtype, buffer=block.buf
+                )[...] = outputs_array
+
+                connection.send(
+                    (
+                        "ok",
+                        (
+                            ("array", outputs_array.shape, outputs_array.dtype.str),
+                            None if states_next is None else list(states_next),
+                        ),
+                    )
+                )
+            except Exception:
+                connection.send(("error", traceback.format_exc()))
+    finally:
+        block.close()
+        connection.close()
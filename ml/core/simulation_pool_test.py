@@ -0,0 +1,142 @@
+# Copyright (c) 2023 Sophie Katz
+#
+# This file is part of Sophie's ML Monorepo.
+#
+# Sophie's ML Monorepo is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Sophie's ML Monorepo is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Sophie's
+# ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
+
+from ml.simulations.minelearning_2d_solid import SimulationMineLearning2DSolid
+from typing import Optional, Tuple
+from .simulation import SimulationBase
+from .simulation_pool import _split_slices, SimulationPool
+import numpy as np
+import numpy.typing as npt
+import pytest
+
+
+class _CounterSimulation(SimulationBase[int, int, int]):
+    def start(self) -> int:
+        return 0
+
+    def step(
+        self, state: Optional[int] = None, input: Optional[int] = None
+    ) -> Tuple[int, Optional[int]]:
+        assert state is not None
+        assert input is not None
+
+        if input < 0:
+            raise ValueError("input must not be negative")
+
+        return state * input, state + input
+
+
+class _ArraySimulation(SimulationBase[None, int, npt.NDArray[np.float64]]):
+    def start(self) -> None:
+        pass
+
+    def step(
+        self, state: None = None, input: Optional[int] = None
+    ) -> Tuple[npt.NDArray[np.float64], None]:
+        assert input is not None
+
+        return np.full((100, 100), input, dtype=np.float64), None
+
+
+def test_split_slices() -> None:
+    assert _split_slices(5, 1) == [(0, 5)]
+    assert _split_slices(5, 2) == [(0, 3), (3, 5)]
+    assert _split_slices(5, 5) == [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5)]
+
+
+def test_objects() -> None:
+    with SimulationPool(_CounterSimulation(), count=5, processes=2) as pool:
+        states = pool.start()
+        assert states == [0, 0, 0, 0, 0]
+
+        outputs, states_next = pool.step(states=[1, 2, 3, 4, 5], inputs=[5, 4, 3, 2, 1])
+        assert outputs == [5, 8, 9, 8, 5]
+        assert states_next == [6, 6, 6, 6, 6]
+
+
+def test_async() -> None:
+    with SimulationPool(_CounterSimulation(), count=3, processes=3) as pool:
+        pool.step_async(states=[1, 2, 3], inputs=[1, 1, 1])
+
+        with pytest.raises(Exception):
+            pool.step_async(states=[1, 2, 3], inputs=[1, 1, 1])
+
+        outputs, states = pool.step_wait()
+        assert outputs == [1, 2, 3]
+        assert states == [2, 3, 4]
+
+        with pytest.raises(Exception):
+            pool.step_wait()
+
+
+def test_arrays_in_shared_memory() -> None:
+    # Each worker's outputs are larger than the initial shared memory block
+    with SimulationPool(_ArraySimulation(), count=4, processes=2) as pool:
+        for offset in range(2):
+            outputs, states = pool.step(inputs=[i + offset for i in range(4)])
+
+            assert isinstance(outputs, np.ndarray)
+            assert outputs.shape == (4, 100, 100)
+            assert states is None
+
+            for i in range(4):
+                assert (outputs[i] == i + offset).all()
+
+
+def test_minelearning() -> None:
+    simulation = SimulationMineLearning2DSolid(
+        5, 3, 2, [(0xFF, 0x00, 0x00), (0x00, 0xFF, 0x00), (0x00, 0x00, 0xFF)]
+    )
+
+    inputs = np.random.default_rng(0).integers(0, 3, size=(6, 2, 3))
+
+    with SimulationPool(simulation, count=6, processes=4) as pool:
+        outputs, _ = pool.step(inputs=inputs)  # type: ignore
+
+    expected, _ = simulation.step_batch(inputs=inputs)
+
+    assert isinstance(outputs, np.ndarray)
+    assert outputs.dtype == expected.dtype
+    assert (outputs == expected).all()
+
+
+def test_error() -> None:
+    with SimulationPool(_CounterSimulation(), count=2, processes=2) as pool:
+        with pytest.raises(Exception, match="input must not be negative"):
+            pool.step(states=[0, 0], inputs=[1, -1])
+
+        # The pool is still usable afterwards
+        outputs, _ = pool.step(states=[1, 1], inputs=[2, 3])
+        assert outputs == [2, 3]
+
+        # Replies from the workers after the one which failed aren't left behind
+        with pytest.raises(Exception, match="input must not be negative"):
+            pool.step(states=[0, 0], inputs=[-1, 1])
+
+        outputs, states = pool.step(states=[1, 1], inputs=[2, 3])
+        assert outputs == [2, 3]
+        assert states == [3, 4]
+
+        with pytest.raises(Exception):
+            pool.step(states=[0], inputs=[1])
+
+
+def test_closed() -> None:
+    pool = SimulationPool(_CounterSimulation(), count=1)
+    pool.close()
+    pool.close()
+
+    with pytest.raises(Exception):
+        pool.start()
@@ -15,6 +15,7 @@
 
 from typing import Optional, Tuple
 from .simulation import *
+import pytest
 
 
 def test_no_state_no_input() -> None:
@@ -135,3 +136,45 @@ def test_with_state_with_input() -> None:
     output, state = simulation.step(state=state, input=3)
     assert output == 3
     assert state == 6
+
+
+def test_step_batch_with_state_with_input() -> None:
+    class MySimulation(SimulationBase[int, int, int]):
+        def start(self) -> int:
+            return 0
+
+        def step(
+            self, state: Optional[int] = None, input: Optional[int] = None
+        ) -> Tuple[int, Optional[int]]:
+            assert state is not None
+            assert input is not None
+
+            return state * input, state + input
+
+    simulation = MySimulation()
+
+    outputs, states = simulation.step_batch(states=[1, 2, 3], inputs=[4, 5, 6])
+    assert list(outputs) == [4, 10, 18]
+    assert states is not None
+    assert list(states) == [5, 7, 9]
+
+
+def test_step_batch_no_state_no_input() -> None:
+    class MySimulation(SimulationBase[None, None, int]):
+        def start(self) -> None:
+            pass
+
+        def step(self, state: None = None, input: None = None) -> Tuple[int, None]:
+            return 5, None
+
+    simulation = MySimulation()
+
+    outputs, states = simulation.step_batch(count=3)
+    assert list(outputs) == [5, 5, 5]
+    assert states is None
+
+    with pytest.raises(Exception):
+        simulation.step_batch()
+
+    with pytest.raises(Exception):
+        simulation.step_batch(states=[None, None], count=3)
@@ -13,19 +13,65 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
-from torch.utils.data import Dataset
+from torch.nn.utils.rnn import pack_padded_sequence, pad_sequence, PackedSequence
+from torch.utils.data import Dataset, Sampler
+from ml.core.extract import _get_archive_identity, _is_archive_unchanged
+from ml.core.repo_paths import get_dir_artifacts_data_cache
 from ml.data.pytorch_name_classification.shared import (
-    download_and_extract,
+    DATA_NAME,
+    download_and_open,
+    get_archive_path,
     load_name_tuples_from_dir,
 )
-from typing import cast, Dict, List, Tuple
+from typing import Any, cast, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import json
+import numpy as np
+import os
+import pathlib
 import torch as T
 import torch.nn as nn
 
+# Bump this whenever ``_load`` changes how the data is preprocessed, so that caches
+# written by older versions are rebuilt
+PREPROCESSING_VERSION = 2
+
+# The preprocessed data is cached in ``get_dir_artifacts_data_cache(DATA_NAME)`` by
+# default. The metadata is written last, so the arrays are only used if it exists and
+# matches.
+CACHE_METADATA_FILENAME = "pytorch.json"
+CACHE_ARRAY_NAMES = ("name_indices", "name_offsets", "culture_indices")
+
+# The default number of batches whose names are sorted by length together by
+# ``NameLengthBatchSampler``
+DEFAULT_BUCKET_BATCH_COUNT = 100
+
 
 class PytorchNameCategorization(Dataset[Tuple[T.Tensor, T.Tensor]]):
-    def __init__(self) -> None:
-        self._data: List[Tuple[T.Tensor, T.Tensor]] = []
+    """
+    The names from the PyTorch name classification tutorial, labeled with their
+    cultures.
+
+    Parameters
+    ----------
+    cache_dir: Optional[Union[str, pathlib.Path]]
+        The directory to cache the preprocessed data in. Defaults to
+        ``get_dir_artifacts_data_cache(DATA_NAME)``.
+    """
+
+    def __init__(self, cache_dir: Optional[Union[str, pathlib.Path]] = None) -> None:
+        self._cache_dir = (
+            get_dir_artifacts_data_cache(DATA_NAME)
+            if cache_dir is None
+            else pathlib.Path(cache_dir)
+        )
+
+        # The names are stored in CSR layout: the alphabet indices of every name
+        # concatenated together, where name ``i`` is
+        # ``_name_indices[_name_offsets[i]:_name_offsets[i + 1]]``. They're one-hot
+        # encoded when accessed.
+        self._name_indices = T.empty(0, dtype=T.uint8)
+        self._name_offsets = T.zeros(1, dtype=T.int64)
+        self._culture_indices = T.empty(0, dtype=T.int64)
         self._alphabet_to_index_mapping: Dict[str, int] = {}
         self._culture_name_index_to_mapping: Dict[str, int] = {}
         self._index_to_culture_name_mapping: Dict[int, str] = {}
@@ -50,26 +96,36 @@ class PytorchNameCategorization(Dataset[Tuple[T.Tensor, T.Tensor]]):
 
         return T.tensor(
             [
-                len(self._data)
+                len(self._culture_indices)
                 / self._culture_name_counts[self._index_to_culture_name_mapping[index]]
                 for index in range(len(self._culture_name_index_to_mapping))
             ]
         )
 
-    def encode_name(self, name: str) -> T.Tensor:
+    def name_lengths(self) -> T.Tensor:
+        """
+        Gets the length of every name in the dataset, in the same order as the items.
+        """
+
         if not self._loaded:
             self._load()
 
-        alphabet_indices = [
-            self._alphabet_to_index_mapping[character] for character in name
-        ]
+        return self._name_offsets[1:] - self._name_offsets[:-1]
 
-        return cast(
-            T.Tensor,
-            nn.functional.one_hot(
-                T.tensor(alphabet_indices),
-                num_classes=len(self._alphabet_to_index_mapping),
-            ).to(T.float32),
+    def sample_weights(self) -> T.Tensor:
+        """
+        Gets the weight of every item in the dataset from ``culture_name_weights``, so
+        that sampling with them draws each culture equally often.
+        """
+
+        return self.culture_name_weights()[self._culture_indices]
+
+    def encode_name(self, name: str) -> T.Tensor:
+        if not self._loaded:
+            self._load()
+
+        return self._one_hot_name(
+            T.tensor([self._alphabet_to_index_mapping[character] for character in name])
         )
 
     def encode_culture_name(self, culture_name: str) -> T.Tensor:
@@ -98,46 +154,341 @@ class PytorchNameCategorization(Dataset[Tuple[T.Tensor, T.Tensor]]):
         if not self._loaded:
             self._load()
 
-        return len(self._data)
+        return len(self._culture_indices)
+
+    def share_memory(self) -> "PytorchNameCategorization":
+        """
+        Loads the dataset if it isn't loaded and moves its tensors to shared memory.
+
+        Call this before creating a ``DataLoader`` with ``num_workers > 0`` so that the
+        data is loaded once and every worker reads the same memory instead of loading
+        or copying it again. It's also called when the dataset is pickled to be sent to
+        workers started with ``spawn`` or ``forkserver``.
+        """
+
+        if not self._loaded:
+            self._load()
+
+        for name in CACHE_ARRAY_NAMES:
+            getattr(self, f"_{name}").share_memory_()
+
+        return self
+
+    def __getstate__(self) -> Dict[str, Any]:
+        self.share_memory()
+
+        return self.__dict__.copy()
 
     def __getitem__(self, index: int) -> Tuple[T.Tensor, T.Tensor]:
         if not self._loaded:
             self._load()
 
-        return self._data[index]
+        if index < 0:
+            index += len(self._culture_indices)
 
-    def _load(self) -> None:
-        names_dir = download_and_extract()
-        names = []
+        if not 0 <= index < len(self._culture_indices):
+            raise IndexError(
+                f"index out of range (index: {index}, length: {len(self._culture_indices)})"
+            )
+
+        begin = int(self._name_offsets[index])
+        end = int(self._name_offsets[index + 1])
 
-        alphabet = set()
-        culture_names = set()
+        return (
+            self._one_hot_name(self._name_indices[begin:end]),
+            self._culture_indices[index],
+        )
 
-        for element in load_name_tuples_from_dir(names_dir):
-            names.append(element)
-            for character in element[1]:
-                alphabet.add(character)
-            culture_names.add(element[0])
+    def _one_hot_name(self, alphabet_indices: T.Tensor) -> T.Tensor:
+        return cast(
+            T.Tensor,
+            nn.functional.one_hot(
+                alphabet_indices.to(T.int64),
+                num_classes=len(self._alphabet_to_index_mapping),
+            ).to(T.float32),
+        )
 
-            if element[0] in self._culture_name_counts:
-                self._culture_name_counts[element[0]] += 1
-            else:
-                self._culture_name_counts[element[0]] = 1
+    def _load(self) -> None:
+        """
+        Loads the preprocessed data from the cache, or preprocesses it and writes the
+        cache if the cache is missing or out of date.
 
-        for index, character in enumerate(sorted(alphabet)):
-            self._alphabet_to_index_mapping[character] = index
+        While the cache matches the downloaded archive, the archive isn't checked for
+        updates. Delete the cache directory to force a check.
+        """
 
-        for index, culture_name in enumerate(sorted(culture_names)):
-            self._culture_name_index_to_mapping[culture_name] = index
-            self._index_to_culture_name_mapping[index] = culture_name
+        if not self._load_cache(self._cache_dir):
+            self._preprocess()
+            self._save_cache(self._cache_dir)
 
-        # Needs to be set here because of the subsequent calls to encode_name and
-        # encode_culture_name.
         self._loaded = True
 
-        for culture_name, name in names:
-            name_encoding = self.encode_name(name)
-            culture_encoding = self.encode_culture_name(culture_name)
+    def _preprocess(self) -> None:
+        names: List[str] = []
+        name_culture_names: List[str] = []
+
+        with download_and_open() as path:
+            for culture_name, name in load_name_tuples_from_dir(path):
+                name_culture_names.append(culture_name)
+                names.append(name)
+
+        # Build the vocabularies and encode every name at once over all of the names
+        # concatenated together. np.unique sorts code points and strings the same way
+        # as Python does.
+        characters = np.frombuffer("".join(names).encode("utf-32-le"), dtype=np.uint32)
+        alphabet, character_indices = np.unique(characters, return_inverse=True)
+
+        culture_names, culture_indices, culture_name_counts = np.unique(
+            np.array(name_culture_names, dtype=str),
+            return_inverse=True,
+            return_counts=True,
+        )
+
+        self._alphabet_to_index_mapping = {
+            chr(code_point): index for index, code_point in enumerate(alphabet)
+        }
+        self._culture_name_index_to_mapping = {
+            str(culture_name): index for index, culture_name in enumerate(culture_names)
+        }
+        self._index_to_culture_name_mapping = {
+            index: str(culture_name) for index, culture_name in enumerate(culture_names)
+        }
+        self._culture_name_counts = {
+            str(culture_name): int(count)
+            for culture_name, count in zip(culture_names, culture_name_counts)
+        }
+
+        name_lengths = np.fromiter(map(len, names), dtype=np.int64, count=len(names))
+        kept = np.array(name_culture_names, dtype=str) != "Arabic"
+
+        self._name_indices = T.from_numpy(
+            character_indices[np.repeat(kept, name_lengths)].astype(
+                np.uint8 if len(alphabet) <= 256 else np.int16
+            )
+        )
+        self._name_offsets = T.from_numpy(
+            np.concatenate(([0], np.cumsum(name_lengths[kept])))
+        )
+        self._culture_indices = T.from_numpy(culture_indices[kept].astype(np.int64))
+
+    def _load_cache(self, cache_dir: pathlib.Path) -> bool:
+        """
+        Loads the preprocessed data from ``cache_dir`` if it was written by the current
+        preprocessing version from the current archive. The arrays are memory-mapped.
+
+        Returns
+        -------
+            Whether the cache was loaded.
+        """
+
+        try:
+            with open(cache_dir / CACHE_METADATA_FILENAME, "r") as file:
+                metadata = cast(Dict[str, Any], json.load(file))
+        except (OSError, ValueError):
+            return False
+
+        if metadata.get("version") != PREPROCESSING_VERSION:
+            return False
+
+        try:
+            if not _is_archive_unchanged(get_archive_path(), metadata["archive"]):
+                return False
+        except (OSError, KeyError, TypeError):
+            # The archive is missing or the metadata is malformed
+            return False
+
+        try:
+            # Copy-on-write mappings are writable, which torch requires, but are only
+            # read from disk as they're used
+            arrays = {
+                name: np.load(cache_dir / f"{name}.npy", mmap_mode="c")
+                for name in CACHE_ARRAY_NAMES
+            }
+        except (OSError, ValueError):
+            return False
+
+        self._alphabet_to_index_mapping = {
+            character: index for index, character in enumerate(metadata["alphabet"])
+        }
+        self._culture_name_index_to_mapping = {
+            culture_name: index
+            for index, culture_name in enumerate(metadata["culture_names"])
+        }
+        self._index_to_culture_name_mapping = dict(enumerate(metadata["culture_names"]))
+        self._culture_name_counts = metadata["culture_name_counts"]
+        self._name_indices = T.from_numpy(arrays["name_indices"])
+        self._name_offsets = T.from_numpy(arrays["name_offsets"])
+        self._culture_indices = T.from_numpy(arrays["culture_indices"])
+
+        return True
+
+    def _save_cache(self, cache_dir: pathlib.Path) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        metadata_path = cache_dir / CACHE_METADATA_FILENAME
+
+        # Invalidate the old cache before replacing its arrays
+        try:
+            os.remove(metadata_path)
+        except FileNotFoundError:
+            pass
+
+        for name in CACHE_ARRAY_NAMES:
+            # Replace the file instead of overwriting it in place, since other
+            # processes may have the old one memory-mapped
+            array_path = cache_dir / f"{name}.npy"
+            array_path_temp = array_path.with_name(
+                f"{array_path.name}.{os.getpid()}.tmp"
+            )
+
+            with open(array_path_temp, "wb") as file:
+                np.save(file, getattr(self, f"_{name}").numpy())
+
+            os.replace(array_path_temp, array_path)
+
+        metadata = {
+            "version": PREPROCESSING_VERSION,
+            "archive": _get_archive_identity(get_archive_path()),
+            "alphabet": sorted(
+                self._alphabet_to_index_mapping,
+                key=self._alphabet_to_index_mapping.__getitem__,
+            ),
+            "culture_names": [
+                self._index_to_culture_name_mapping[index]
+                for index in range(len(self._index_to_culture_name_mapping))
+            ],
+            "culture_name_counts": self._culture_name_counts,
+        }
+
+        metadata_path_temp = metadata_path.with_name(
+            f"{metadata_path.name}.{os.getpid()}.tmp"
+        )
+
+        with open(metadata_path_temp, "w") as file:
+            json.dump(metadata, file)
+
+        os.replace(metadata_path_temp, metadata_path)
+
+
+class NameLengthBatchSampler(Sampler[List[int]]):
+    """
+    A batch sampler which groups names of similar length together to minimize the
+    padding needed to batch them.
+
+    Indices are drawn at random, by ``weights`` if given. Every ``bucket_batch_count``
+    batches worth of indices are sorted by length and split into batches, and then the
+    order of all of the batches is shuffled.
+
+    Parameters
+    ----------
+    lengths: T.Tensor
+        The length of each name, such as from ``PytorchNameCategorization.name_lengths``
+    batch_size: int
+        The number of indices in each batch. The last batch of each bucket may be
+        smaller.
+    weights: Optional[T.Tensor]
+        If given, indices are drawn with replacement with these relative weights, such
+        as from ``PytorchNameCategorization.sample_weights`` to balance the cultures.
+        Otherwise every index is drawn once before any is drawn again.
+    num_samples: Optional[int]
+        The number of indices to draw per epoch. Defaults to the number of names.
+    bucket_batch_count: int
+        The number of batches whose names are sorted by length together. Larger values
+        reduce padding but make batches less random.
+    generator: Optional[T.Generator]
+        The random number generator to use
+    """
+
+    def __init__(
+        self,
+        lengths: T.Tensor,
+        batch_size: int,
+        weights: Optional[T.Tensor] = None,
+        num_samples: Optional[int] = None,
+        bucket_batch_count: int = DEFAULT_BUCKET_BATCH_COUNT,
+        generator: Optional[T.Generator] = None,
+    ) -> None:
+        if num_samples is None:
+            num_samples = len(lengths)
+
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.weights = weights
+        self.num_samples = num_samples
+        self.bucket_batch_count = bucket_batch_count
+        self.generator = generator
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.weights is None:
+            # Like RandomSampler, draw from as many permutations as needed
+            permutation_count = -(-self.num_samples // max(len(self.lengths), 1))
+            indices = T.cat(
+                [
+                    T.randperm(len(self.lengths), generator=self.generator)
+                    for _ in range(permutation_count)
+                ]
+            )[: self.num_samples]
+        else:
+            indices = T.multinomial(
+                self.weights.to(T.float64),
+                self.num_samples,
+                replacement=True,
+                generator=self.generator,
+            )
+
+        batches: List[T.Tensor] = []
+
+        for bucket in T.split(indices, self.batch_size * self.bucket_batch_count):
+            bucket = bucket[T.argsort(self.lengths[bucket], stable=True)]
+            batches.extend(T.split(bucket, self.batch_size))
+
+        for batch_index in T.randperm(len(batches), generator=self.generator):
+            yield batches[batch_index].tolist()
+
+    def __len__(self) -> int:
+        bucket_size = self.batch_size * self.bucket_batch_count
+        full_buckets, remainder = divmod(self.num_samples, bucket_size)
+
+        return full_buckets * self.bucket_batch_count + -(-remainder // self.batch_size)
+
+
+def collate_padded(
+    batch: Sequence[Tuple[T.Tensor, T.Tensor]],
+) -> Tuple[T.Tensor, T.Tensor, T.Tensor]:
+    """
+    Collates items from ``PytorchNameCategorization`` into a batch.
+
+    Returns
+    -------
+        A tuple of the names padded with zeros to shape
+        ``(batch, longest name, alphabet)``, the length of each name, and the culture
+        indices.
+    """
+
+    names = [name for name, _ in batch]
+
+    return (
+        pad_sequence(names, batch_first=True),
+        T.tensor([len(name) for name in names], dtype=T.int64),
+        T.stack([culture for _, culture in batch]),
+    )
+
+
+def collate_packed(
+    batch: Sequence[Tuple[T.Tensor, T.Tensor]],
+) -> Tuple[PackedSequence, T.Tensor]:
+    """
+    Collates items from ``PytorchNameCategorization`` into a batch.
+
+    Returns
+    -------
+        A tuple of the names as a batch-first ``PackedSequence`` and the culture
+        indices.
+    """
+
+    names, lengths, cultures = collate_padded(batch)
 
-            if culture_name != "Arabic":
-                self._data.append((name_encoding, culture_encoding))
+    return (
+        pack_padded_sequence(names, lengths, batch_first=True, enforce_sorted=False),
+        cultures,
+    )
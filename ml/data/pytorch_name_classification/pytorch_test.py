@@ -13,7 +13,19 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
-from ml.data.pytorch_name_classification.pytorch import PytorchNameCategorization
+from ml.data.pytorch_name_classification import pytorch
+from ml.data.pytorch_name_classification.pytorch import (
+    collate_packed,
+    collate_padded,
+    NameLengthBatchSampler,
+    PREPROCESSING_VERSION,
+    PytorchNameCategorization,
+)
+from torch.utils.data import DataLoader
+import os
+import pathlib
+import pytest
+import torch as T
 
 
 def test_len() -> None:
@@ -29,3 +41,154 @@ def test_items() -> None:
 
     assert dataset[100][0].shape == (5, 87)
     assert dataset[100][1].shape == (18,)
+
+
+def test_items_one_hot() -> None:
+    dataset = PytorchNameCategorization()
+
+    for index in (0, 100, len(dataset) - 1):
+        name_encoding, culture_encoding = dataset[index]
+
+        assert name_encoding.dtype == T.float32
+        assert (name_encoding.sum(dim=1) == 1).all()
+        assert culture_encoding.dtype == T.int64
+
+    assert T.equal(dataset[-1][0], dataset[len(dataset) - 1][0])
+
+    with pytest.raises(IndexError):
+        dataset[len(dataset)]
+
+
+def test_cache(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    preprocessed = PytorchNameCategorization(tmp_path)
+    preprocessed._preprocess()
+
+    # The cache is written by the first load
+    assert len(PytorchNameCategorization(tmp_path)) == len(preprocessed)
+    assert (tmp_path / pytorch.CACHE_METADATA_FILENAME).exists()
+
+    cached = PytorchNameCategorization(tmp_path)
+    assert cached._load_cache(tmp_path)
+
+    assert cached._alphabet_to_index_mapping == preprocessed._alphabet_to_index_mapping
+    assert cached._culture_name_counts == preprocessed._culture_name_counts
+    assert T.equal(cached._name_indices, preprocessed._name_indices)
+    assert T.equal(cached._name_offsets, preprocessed._name_offsets)
+    assert T.equal(cached._culture_indices, preprocessed._culture_indices)
+
+    # Rebuilding replaces the arrays instead of overwriting the files that are mapped
+    array_path = tmp_path / "name_indices.npy"
+    inode = os.stat(array_path).st_ino
+
+    preprocessed._save_cache(tmp_path)
+
+    assert os.stat(array_path).st_ino != inode
+    assert T.equal(cached._name_indices, preprocessed._name_indices)
+
+    monkeypatch.setattr(pytorch, "PREPROCESSING_VERSION", PREPROCESSING_VERSION + 1)
+
+    assert not PytorchNameCategorization(tmp_path)._load_cache(tmp_path)
+
+
+def test_name_lengths() -> None:
+    dataset = PytorchNameCategorization()
+
+    lengths = dataset.name_lengths()
+    assert len(lengths) == len(dataset)
+    assert lengths[100] == dataset[100][0].shape[0]
+
+    weights = dataset.sample_weights()
+    assert len(weights) == len(dataset)
+
+
+def test_collate_padded() -> None:
+    batch = [
+        (T.eye(3)[[0, 1]], T.tensor(1)),
+        (T.eye(3)[[2]], T.tensor(0)),
+        (T.eye(3)[[1, 1, 2]], T.tensor(2)),
+    ]
+
+    names, lengths, cultures = collate_padded(batch)
+
+    assert names.shape == (3, 3, 3)
+    assert lengths.tolist() == [2, 1, 3]
+    assert cultures.tolist() == [1, 0, 2]
+    assert T.equal(names[0, :2], batch[0][0])
+    assert (names[1, 1:] == 0).all()
+
+    packed, cultures = collate_packed(batch)
+
+    assert packed.batch_sizes.tolist() == [3, 2, 1]
+    assert cultures.tolist() == [1, 0, 2]
+
+
+def test_name_length_batch_sampler() -> None:
+    lengths = T.randint(1, 20, (1000,), generator=T.Generator().manual_seed(0))
+
+    sampler = NameLengthBatchSampler(
+        lengths,
+        batch_size=32,
+        bucket_batch_count=10,
+        generator=T.Generator().manual_seed(0),
+    )
+
+    batches = list(sampler)
+
+    assert len(batches) == len(sampler)
+    assert sorted(index for batch in batches for index in batch) == list(range(1000))
+
+    # Sorting buckets by length means most batches have few distinct lengths
+    spreads = [int(lengths[batch].max() - lengths[batch].min()) for batch in batches]
+    assert sum(spreads) / len(spreads) < 3
+
+
+def test_name_length_batch_sampler_weights() -> None:
+    lengths = T.ones(100, dtype=T.int64)
+    weights = T.zeros(100)
+    weights[:10] = 1
+
+    sampler = NameLengthBatchSampler(
+        lengths,
+        batch_size=8,
+        weights=weights,
+        num_samples=500,
+        generator=T.Generator().manual_seed(0),
+    )
+
+    indices = [index for batch in sampler for index in batch]
+
+    assert len(indices) == 500
+    assert all(index < 10 for index in indices)
+
+
+def test_share_memory() -> None:
+    dataset = PytorchNameCategorization()
+
+    state = dataset.__getstate__()
+
+    assert state["_loaded"]
+    assert state["_name_indices"].is_shared()
+    assert state["_name_offsets"].is_shared()
+    assert state["_culture_indices"].is_shared()
+
+
+def test_data_loader_workers() -> None:
+    dataset = PytorchNameCategorization().share_memory()
+
+    loader = DataLoader(
+        dataset,
+        batch_size=4,
+        collate_fn=collate_padded,
+        num_workers=2,
+        multiprocessing_context="spawn",
+    )
+
+    names, lengths, cultures = next(iter(loader))
+
+    expected_names, expected_lengths, expected_cultures = collate_padded(
+        [dataset[i] for i in range(4)]
+    )
+
+    assert T.equal(names, expected_names)
+    assert T.equal(lengths, expected_lengths)
+    assert T.equal(cultures, expected_cultures)
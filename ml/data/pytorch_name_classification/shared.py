@@ -13,20 +13,68 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import pathlib
+import queue
+import threading
 import unicodedata
-from typing import Iterable, Tuple
+import zipfile
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from ml.core.download import download_http
-from ml.core.extract import extract_archive
+from ml.core.extract import extract_archive, open_archive
 from ml.core.repo_paths import (
     get_dir_artifacts_data_raw,
     get_dir_artifacts_data_intermediate,
+    get_dir_artifacts_downloads,
 )
 
 DATA_NAME = "pytorch_name_classification"
 DOWNLOAD_URL = "https://download.pytorch.org/tutorial/data.zip"
 DOWNLOAD_FILENAME = "data.zip"
 
+# The number of characters ``load_name_tuples_from_dir`` reads from a file at a time
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# When ``load_name_tuples_from_dir`` reads files in a thread pool, lines are passed to
+# the consumer in chunks of this many, with up to this many chunks per file buffered
+READ_CHUNK_LINES = 1024
+READ_AHEAD_CHUNKS = 4
+
+
+def get_archive_path() -> pathlib.Path:
+    """
+    Gets the path that ``download`` downloads the archive to, without downloading it.
+
+    Returns
+    -------
+
+        A ``pathlib.Path`` path to the archive, which may not exist.
+    """
+
+    return get_dir_artifacts_data_raw(DATA_NAME) / DOWNLOAD_FILENAME
+
+
+def download() -> pathlib.Path:
+    """
+    Downloads the archive for the PyTorch name classification tutorial.
+
+    Returns
+    -------
+
+        A ``pathlib.Path`` path to the downloaded archive.
+    """
+
+    get_dir_artifacts_data_raw(DATA_NAME, create=True)
+
+    path_data = get_archive_path()
+
+    download_http(
+        DOWNLOAD_URL, path_data, cache_dir=get_dir_artifacts_downloads(create=True)
+    )
+
+    return path_data
+
 
 def download_and_extract() -> pathlib.Path:
     """
@@ -38,46 +86,72 @@ def download_and_extract() -> pathlib.Path:
         A ``pathlib.Path`` path to the directory containing the name files.
     """
 
-    path_dir_artifacts_data_raw = get_dir_artifacts_data_raw(DATA_NAME, create=True)
     path_dir_artifacts_data_intermediate = get_dir_artifacts_data_intermediate(
         DATA_NAME, create=True
     )
 
-    path_data = path_dir_artifacts_data_raw / DOWNLOAD_FILENAME
+    extract_archive(download(), path_dir_artifacts_data_intermediate)
 
-    download_http(DOWNLOAD_URL, path_data)
+    return path_dir_artifacts_data_intermediate / "data" / "names"
 
-    extract_archive(path_data, path_dir_artifacts_data_intermediate)
 
-    return path_dir_artifacts_data_intermediate / "data" / "names"
+@contextlib.contextmanager
+def download_and_open() -> Iterator[zipfile.Path]:
+    """
+    Downloads the data for the PyTorch name classification tutorial and opens it in
+    place without extracting it, closing the archive on exit.
+
+    Returns
+    -------
+
+        A context manager giving a ``zipfile.Path`` path to the directory containing
+        the name files within the archive, which can be passed to
+        ``load_name_tuples_from_dir``.
+    """
+
+    with open_archive(download(), "data/names/") as path:
+        yield path
+
+
+class _AsciiTranslationTable(Dict[int, Optional[str]]):
+    """
+    A ``str.translate`` table which removes nonspacing marks, such as the accents split
+    off of characters by NFD normalization, and converts non-breaking spaces to spaces.
+    Each code point's Unicode category is only looked up the first time it's seen.
+    """
 
+    def __missing__(self, code_point: int) -> Optional[str]:
+        character = chr(code_point)
 
-def _convert_to_ascii_normalize_str(text: str) -> str:
-    return unicodedata.normalize("NFD", text)
+        translation: Optional[str]
 
+        if character == "\xa0":
+            translation = " "
+        elif unicodedata.category(character) == "Mn":
+            translation = None
+        else:
+            translation = character
 
-def _convert_to_ascii_normalize_chr(c: str) -> str:
-    if c == "\xa0":
-        return " "
-    else:
-        return c
+        self[code_point] = translation
+
+        return translation
+
+
+_ASCII_TRANSLATION_TABLE = _AsciiTranslationTable()
 
 
 def convert_to_ascii(text: str) -> str:
     """
     Converts a string with unicode characters to ASCII by converting non-ASCII
     characters to similar ASCII characters. For example, é becomes e.
+
+    The whole string is converted at once, so it's faster to convert a whole file than
+    each line separately.
     """
-    return "".join(
-        [
-            _convert_to_ascii_normalize_chr(c)
-            for c in _convert_to_ascii_normalize_str(text)
-            if unicodedata.category(c) != "Mn"
-        ]
-    )
+    return unicodedata.normalize("NFD", text).translate(_ASCII_TRANSLATION_TABLE)
 
 
-def get_culture_name_from_file_path(path: pathlib.Path) -> str:
+def get_culture_name_from_file_path(path: Union[pathlib.Path, zipfile.Path]) -> str:
     """
     Gets the culture name from the file path of a name file.
 
@@ -94,17 +168,33 @@ def get_culture_name_from_file_path(path: pathlib.Path) -> str:
     return path.name.split(".")[0]
 
 
-def load_name_tuples_from_dir(path: pathlib.Path) -> Iterable[Tuple[str, str]]:
+def load_name_tuples_from_dir(
+    path: Union[pathlib.Path, zipfile.Path],
+    buffer_size: int = DEFAULT_BUFFER_SIZE,
+    workers: int = 1,
+) -> Iterable[Tuple[str, str]]:
     """
     Loads the name tuples from the name directory.
 
     The name tuples are in the format ``(culture_name, name)`` where ``culture_name``
-    is the name of the culture and ``name`` is the name from that culture.
+    is the name of the culture and ``name`` is the name from that culture. The files are
+    read in order of their names, so the order of the tuples is the same on every
+    machine.
+
+    Files are read lazily in chunks, so memory use doesn't depend on the size of the
+    files.
 
     Parameters
     ----------
     ``path``
-        The path to the name directory.
+        The path to the name directory, either on disk or within an archive opened with
+        ``download_and_open``.
+    ``buffer_size``
+        The number of characters to read from a file at a time.
+    ``workers``
+        If more than 1, this many files are read at once in a thread pool, with up to
+        ``READ_AHEAD_CHUNKS`` chunks of each buffered ahead of the consumer. The tuples
+        are still in the same order.
 
     Returns
     -------
@@ -113,8 +203,103 @@ def load_name_tuples_from_dir(path: pathlib.Path) -> Iterable[Tuple[str, str]]:
 
     assert path.is_dir(), "path must be a directory"
 
-    for name_path in path.iterdir():
-        culture_name = get_culture_name_from_file_path(name_path)
-        with open(name_path, "r", encoding="utf-8") as file:
-            for line in file.readlines():
-                yield (culture_name, line.strip())
+    name_paths: List[Union[pathlib.Path, zipfile.Path]] = list(path.iterdir())
+    name_paths.sort(key=lambda name_path: name_path.name)
+
+    if workers <= 1:
+        for name_path in name_paths:
+            culture_name = get_culture_name_from_file_path(name_path)
+
+            for line in _read_lines(name_path, buffer_size):
+                yield (culture_name, line)
+
+        return
+
+    stopped = threading.Event()
+
+    def read(name_path: Union[pathlib.Path, zipfile.Path]) -> "queue.Queue[Any]":
+        lines: "queue.Queue[Any]" = queue.Queue(maxsize=READ_AHEAD_CHUNKS)
+
+        def put(element: Any) -> bool:
+            # Gives up if the consumer has stopped, so that the thread can exit
+            while not stopped.is_set():
+                try:
+                    lines.put(element, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        def run() -> None:
+            try:
+                chunk: List[str] = []
+
+                for line in _read_lines(name_path, buffer_size):
+                    chunk.append(line)
+
+                    if len(chunk) >= READ_CHUNK_LINES:
+                        if not put(chunk):
+                            return
+
+                        chunk = []
+
+                put(chunk)
+                put(None)
+            except BaseException as exception:
+                put(exception)
+
+        executor.submit(run)
+
+        return lines
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            # Threads are started in file order, so the file being consumed is always
+            # being read
+            line_queues = [read(name_path) for name_path in name_paths]
+
+            for name_path, lines in zip(name_paths, line_queues):
+                culture_name = get_culture_name_from_file_path(name_path)
+
+                while True:
+                    chunk = lines.get()
+
+                    if chunk is None:
+                        break
+
+                    if isinstance(chunk, BaseException):
+                        raise chunk
+
+                    for line in chunk:
+                        yield (culture_name, line)
+        finally:
+            stopped.set()
+
+
+def _read_lines(
+    name_path: Union[pathlib.Path, zipfile.Path], buffer_size: int
+) -> Iterator[str]:
+    """
+    Reads the stripped lines of a file, reading ``buffer_size`` characters at a time.
+    """
+
+    with name_path.open("r", encoding="utf-8") as file:
+        pending = ""
+
+        while True:
+            text = file.read(buffer_size)
+
+            if len(text) == 0:
+                break
+
+            lines = (pending + text).split("\n")
+            pending = lines.pop()
+
+            for line in lines:
+                yield line.strip()
+
+        # The last line is only a line if it isn't empty, since a trailing newline
+        # doesn't start another line
+        if len(pending) > 0:
+            yield pending.strip()
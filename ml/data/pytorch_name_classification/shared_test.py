@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
+from ml.core.extract import open_archive
 from ml.data.pytorch_name_classification.shared import (
     download_and_extract,
     convert_to_ascii,
@@ -21,6 +22,8 @@ from ml.data.pytorch_name_classification.shared import (
 )
 import pathlib
 import itertools
+import pytest
+import zipfile
 
 
 def test_convert_to_ascii() -> None:
@@ -48,3 +51,69 @@ def test_load_name_tuples_from_dir() -> None:
 
         assert element[0] == "Arabic"
         assert len(element[1]) > 0
+
+
+def test_load_name_tuples_from_dir_archive(tmp_path: pathlib.Path) -> None:
+    archive_path = tmp_path / "data.zip"
+
+    with zipfile.ZipFile(archive_path, "w") as zip_file:
+        zip_file.writestr("data/names/Icelandic.txt", "Björk\nSigur\n")
+
+    with open_archive(archive_path, "data/names/") as path:
+        tuples = list(load_name_tuples_from_dir(path))
+
+    assert tuples == [("Icelandic", "Björk"), ("Icelandic", "Sigur")]
+
+
+def test_convert_to_ascii_whole_file() -> None:
+    lines = ["Ég er að læra íslansku", "Ślusarski", "Nguyễn\xa0Văn", ""]
+
+    assert convert_to_ascii("\n".join(lines)) == "\n".join(
+        convert_to_ascii(line) for line in lines
+    )
+
+
+def test_load_name_tuples_from_dir_sorted(tmp_path: pathlib.Path) -> None:
+    for culture_name in ("Scottish", "Czech", "Irish"):
+        (tmp_path / f"{culture_name}.txt").write_text(f"{culture_name}1\n")
+
+    tuples = list(load_name_tuples_from_dir(tmp_path))
+
+    assert [culture_name for culture_name, _ in tuples] == [
+        "Czech",
+        "Irish",
+        "Scottish",
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_load_name_tuples_from_dir_buffer_size(
+    tmp_path: pathlib.Path, workers: int
+) -> None:
+    (tmp_path / "A.txt").write_text("Abe \n\nBéatrice\r\nCy")
+    (tmp_path / "B.txt").write_text("".join(f"B{i}\n" for i in range(5000)))
+    (tmp_path / "C.txt").write_text("")
+
+    expected = [("A", "Abe"), ("A", ""), ("A", "Béatrice"), ("A", "Cy")] + [
+        ("B", f"B{i}") for i in range(5000)
+    ]
+
+    for buffer_size in (1, 3, 1024):
+        assert (
+            list(
+                load_name_tuples_from_dir(
+                    tmp_path, buffer_size=buffer_size, workers=workers
+                )
+            )
+            == expected
+        )
+
+
+def test_load_name_tuples_from_dir_workers_stop(tmp_path: pathlib.Path) -> None:
+    for culture_name in ("A", "B", "C"):
+        (tmp_path / f"{culture_name}.txt").write_text("Name\n" * 100000)
+
+    # Stopping early doesn't wait for the files to be read
+    for element in load_name_tuples_from_dir(tmp_path, workers=3):
+        assert element == ("A", "Name")
+        break
@@ -0,0 +1,207 @@
+# Copyright (c) 2023 Sophie Katz
+#
+# This file is part of Sophie's ML Monorepo.
+#
+# Sophie's ML Monorepo is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Sophie's ML Monorepo is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Sophie's
+# ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
+
+from ml.core.simulation import SimulationBase
+from torch.utils.data import get_worker_info, IterableDataset
+from typing import Any, Callable, Iterator, Optional, Tuple, TypeVar
+import numpy as np
+import queue
+import threading
+import torch as T
+
+# The number of samples generated with each call to ``step_batch`` when the dataset
+# yields single samples
+GENERATION_BATCH_SIZE = 64
+
+# Generates a sequence or array of ``count`` inputs for the simulation using the random
+# number generator
+InputGenerator = Callable[[np.random.Generator, int], Any]
+
+Element = TypeVar("Element")
+
+
+class SimulationDataset(IterableDataset[Tuple[Any, Any]]):
+    """
+    A PyTorch dataset which streams ``(input, output)`` pairs from a simulation, with
+    inputs made by ``input_generator``. Nothing is materialized up front, so memory use
+    is constant no matter how many samples are drawn.
+
+    Each sample is ``simulation.step(simulation.start(), input)``. Samples are generated
+    in batches with ``simulation.step_batch``, which simulations can vectorize.
+
+    When loaded with multiple ``DataLoader`` workers, each worker generates its own
+    share of ``length`` samples with its own random number generator.
+
+    Parameters
+    ----------
+    simulation: SimulationBase
+        The simulation to generate outputs with
+    input_generator: InputGenerator
+        A function taking a ``numpy.random.Generator`` and a count which returns that
+        many inputs for the simulation, for example as an array of shape
+        ``(count, ...)``
+    length: Optional[int]
+        The number of samples per epoch across all workers, or ``None`` to generate
+        samples forever
+    batch_size: Optional[int]
+        If set, yields batches of ``(inputs, outputs)`` as returned by the input
+        generator and ``step_batch`` instead of single samples. Use with
+        ``DataLoader(dataset, batch_size=None)``. The last batch of each worker may be
+        smaller.
+    seed: Optional[int]
+        If set, the data generated by each worker depends only on the seed, the epoch
+        set with ``set_epoch``, the worker's index and the number of workers. Otherwise
+        it's seeded from PyTorch's random number generator like ``DataLoader`` does.
+    prefetch: int
+        If positive, batches are generated in a background thread up to this many
+        batches ahead of the consumer
+    """
+
+    def __init__(
+        self,
+        simulation: SimulationBase[Any, Any, Any],
+        input_generator: InputGenerator,
+        length: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        seed: Optional[int] = None,
+        prefetch: int = 0,
+    ) -> None:
+        if batch_size is not None and batch_size <= 0:
+            raise Exception(f"batch size must be positive (batch size: {batch_size})")
+
+        self.simulation = simulation
+        self.input_generator = input_generator
+        self.length = length
+        self.batch_size = batch_size
+        self.seed = seed
+        self.prefetch = prefetch
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch, which changes the data generated when ``seed`` is set.
+        """
+
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        worker_info = get_worker_info()
+
+        if worker_info is None:
+            worker_id, worker_count = 0, 1
+        else:
+            worker_id, worker_count = worker_info.id, worker_info.num_workers
+
+        if self.seed is not None:
+            entropy = [self.seed, self.epoch, worker_id, worker_count]
+        elif worker_info is not None:
+            # DataLoader gives every worker a different seed for every epoch
+            entropy = [worker_info.seed]
+        else:
+            entropy = [int(T.empty((), dtype=T.int64).random_().item())]
+
+        rng = np.random.default_rng(np.random.SeedSequence(entropy))
+
+        if self.length is None:
+            shard_length = None
+        else:
+            size, remainder = divmod(self.length, worker_count)
+            shard_length = size + (1 if worker_id < remainder else 0)
+
+        batches = self._generate_batches(rng, shard_length)
+
+        if self.prefetch > 0:
+            batches = _prefetch(batches, self.prefetch)
+
+        if self.batch_size is not None:
+            yield from batches
+        else:
+            for inputs, outputs in batches:
+                yield from zip(inputs, outputs)
+
+    def _generate_batches(
+        self, rng: np.random.Generator, shard_length: Optional[int]
+    ) -> Iterator[Tuple[Any, Any]]:
+        batch_size = self.batch_size or GENERATION_BATCH_SIZE
+        remaining = shard_length
+
+        while remaining is None or remaining > 0:
+            count = batch_size if remaining is None else min(batch_size, remaining)
+
+            inputs = self.input_generator(rng, count)
+            outputs, _ = self.simulation.step_batch(
+                [self.simulation.start() for _ in range(count)], inputs, count
+            )
+
+            yield inputs, outputs
+
+            if remaining is not None:
+                remaining -= count
+
+
+def _prefetch(iterator: Iterator[Element], size: int) -> Iterator[Element]:
+    """
+    Runs ``iterator`` in a background thread, keeping up to ``size`` of its elements in
+    a queue.
+    """
+
+    # Marks the end of the iterator
+    done = object()
+
+    elements: "queue.Queue[Any]" = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    error: Optional[BaseException] = None
+
+    def run() -> None:
+        nonlocal error
+
+        try:
+            for element in iterator:
+                # Give up on putting the element if the consumer has stopped
+                while not stopped.is_set():
+                    try:
+                        elements.put(element, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                else:
+                    return
+        except BaseException as exception:
+            error = exception
+        finally:
+            while not stopped.is_set():
+                try:
+                    elements.put(done, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            element = elements.get()
+
+            if element is done:
+                break
+
+            yield element
+
+        if error is not None:
+            raise error
+    finally:
+        stopped.set()
+        thread.join()
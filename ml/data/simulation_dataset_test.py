@@ -0,0 +1,118 @@
+# Copyright (c) 2023 Sophie Katz
+#
+# This file is part of Sophie's ML Monorepo.
+#
+# Sophie's ML Monorepo is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Sophie's ML Monorepo is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Sophie's
+# ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
+
+from ml.simulations.minelearning_2d_solid import SimulationMineLearning2DSolid
+from torch.utils.data import DataLoader
+from typing import Any, Iterator
+from .simulation_dataset import _prefetch, SimulationDataset
+import numpy as np
+import numpy.typing as npt
+import pytest
+
+
+def _generate_maps(rng: np.random.Generator, count: int) -> npt.NDArray[np.int64]:
+    return rng.integers(0, 3, size=(count, 2, 3))
+
+
+def _make_dataset(**kwargs: Any) -> SimulationDataset:
+    simulation = SimulationMineLearning2DSolid(
+        5, 3, 2, [(0xFF, 0x00, 0x00), (0x00, 0xFF, 0x00), (0x00, 0x00, 0xFF)]
+    )
+
+    return SimulationDataset(simulation, _generate_maps, **kwargs)
+
+
+def test_samples() -> None:
+    dataset = _make_dataset(length=100, seed=0)
+
+    samples = list(dataset)
+    assert len(samples) == 100
+
+    for input, output in samples:
+        assert output.shape == (3, 5, 3)
+        assert (output == dataset.simulation.step(input=input)[0]).all()
+
+
+def test_seed() -> None:
+    first = list(_make_dataset(length=10, seed=0))
+    second = list(_make_dataset(length=10, seed=0))
+    other = list(_make_dataset(length=10, seed=1))
+
+    assert all((a[0] == b[0]).all() for a, b in zip(first, second))
+    assert any((a[0] != b[0]).any() for a, b in zip(first, other))
+
+    dataset = _make_dataset(length=10, seed=0)
+    dataset.set_epoch(1)
+    next_epoch = list(dataset)
+
+    assert any((a[0] != b[0]).any() for a, b in zip(first, next_epoch))
+
+
+def test_batches() -> None:
+    batches = list(_make_dataset(length=10, batch_size=4, seed=0))
+
+    assert [len(inputs) for inputs, _ in batches] == [4, 4, 2]
+    assert [np.shape(outputs) for _, outputs in batches] == [
+        (4, 3, 5, 3),
+        (4, 3, 5, 3),
+        (2, 3, 5, 3),
+    ]
+
+
+def test_unbounded() -> None:
+    iterator = iter(_make_dataset())
+
+    for _ in range(1000):
+        next(iterator)
+
+
+def test_prefetch() -> None:
+    expected = list(_make_dataset(length=200, batch_size=8, seed=0))
+    actual = list(_make_dataset(length=200, batch_size=8, seed=0, prefetch=2))
+
+    assert len(actual) == len(expected)
+
+    for (a_inputs, a_outputs), (b_inputs, b_outputs) in zip(actual, expected):
+        assert (a_inputs == b_inputs).all()
+        assert (a_outputs == b_outputs).all()
+
+    # Stopping early stops the background thread
+    for _ in _make_dataset(batch_size=8, prefetch=2):
+        break
+
+
+def test_prefetch_error() -> None:
+    def generate() -> Iterator[Any]:
+        yield 1
+        raise ValueError("generation failed")
+
+    iterator = _prefetch(generate(), 1)
+
+    assert next(iterator) == 1
+
+    with pytest.raises(ValueError):
+        next(iterator)
+
+
+def test_data_loader_workers() -> None:
+    dataset = _make_dataset(length=25, batch_size=4, seed=0)
+    loader = DataLoader(dataset, batch_size=None, num_workers=2)
+
+    batches = list(loader)
+    inputs = np.concatenate([batch_inputs.numpy() for batch_inputs, _ in batches])
+
+    # Each worker generated its own share of the samples with its own seed
+    assert sum(len(batch_inputs) for batch_inputs, _ in batches) == 25
+    assert len({tuple(map_.flatten()) for map_ in inputs}) > 20
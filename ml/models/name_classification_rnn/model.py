@@ -13,12 +13,14 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
-from typing import cast, Tuple
+from typing import cast, List, Optional, Sequence, Tuple
 import torch as T
 import torch.nn as nn
 import pathlib
-from ml.data.pytorch_name_classification.pytorch import PytorchNameCategorization
-
+from ml.data.pytorch_name_classification.pytorch import (
+    collate_padded,
+    PytorchNameCategorization,
+)
 
 HIDDEN_SIZE = 128
 
@@ -26,7 +28,8 @@ HIDDEN_SIZE = 128
 class NameClassificationRNN(nn.Module):
     @staticmethod
     def load(path: pathlib.Path) -> "NameClassificationRNN":
-        return cast(NameClassificationRNN, T.load(path))
+        # Checkpoints are whole pickled modules rather than state dicts
+        return cast(NameClassificationRNN, T.load(path, weights_only=False))
 
     def __init__(
         self,
@@ -42,38 +45,169 @@ class NameClassificationRNN(nn.Module):
             alphabet_count + hidden_size,
             culture_name_count,
         )
-        self.softmax = nn.LogSoftmax(dim=0)
 
     def forward(
         self, input_tensor: T.Tensor, hidden_tensor: T.Tensor
     ) -> Tuple[T.Tensor, T.Tensor]:
-        combined_tensor = T.cat((input_tensor, hidden_tensor), 0)
+        """
+        Runs a single timestep. The inputs can either be a single character of shape
+        ``(alphabet,)`` with a hidden tensor of shape ``(hidden,)``, or a batch of them
+        with shapes ``(batch, alphabet)`` and ``(batch, hidden)``.
+        """
+
+        combined_tensor = T.cat((input_tensor, hidden_tensor), -1)
         hidden_tensor = self.input_to_hidden(combined_tensor)
         output_tensor = self.input_to_output(combined_tensor)
-        output_tensor = self.softmax(output_tensor)
+        output_tensor = nn.functional.log_softmax(output_tensor, dim=-1)
 
         return output_tensor, hidden_tensor
 
-    def create_hidden_initial(self) -> T.Tensor:
-        return T.zeros(self.hidden_size)
+    def forward_sequence(
+        self, names: T.Tensor, lengths: T.Tensor, fused: bool = False
+    ) -> T.Tensor:
+        """
+        Runs a batch of names padded to the same length, such as from
+        ``collate_padded``.
+
+        Parameters
+        ----------
+        names: T.Tensor
+            The one-hot encoded names, of shape ``(batch, longest name, alphabet)``
+        lengths: T.Tensor
+            The length of each name, of shape ``(batch,)``
+        fused: bool
+            If true, runs the names through ``_forward_sequence_fused``, a TorchScript
+            function computing the same thing with less overhead per character
+
+        Returns
+        -------
+            The log probabilities of each culture for each name after its last
+            character, of shape ``(batch, culture count)``.
+        """
+
+        if fused:
+            return cast(
+                T.Tensor,
+                _forward_sequence_fused(
+                    names,
+                    lengths.to(names.device),
+                    self.input_to_hidden.weight,
+                    self.input_to_hidden.bias,
+                    self.input_to_output.weight,
+                    self.input_to_output.bias,
+                ),
+            )
+
+        hidden_tensor = self.create_hidden_initial(names.shape[0]).to(names.device)
+
+        # The output only depends on the combined tensor at the last character of each
+        # name, so only that is kept while stepping through the names
+        last_combined_tensor = T.zeros(
+            names.shape[0], names.shape[2] + self.hidden_size, device=names.device
+        )
+        last_steps = (lengths - 1).to(names.device).unsqueeze(1)
+
+        for step in range(names.shape[1]):
+            combined_tensor = T.cat((names[:, step], hidden_tensor), -1)
+            last_combined_tensor = T.where(
+                last_steps == step, combined_tensor, last_combined_tensor
+            )
+            hidden_tensor = self.input_to_hidden(combined_tensor)
+
+        return nn.functional.log_softmax(
+            self.input_to_output(last_combined_tensor), dim=-1
+        )
+
+    def create_hidden_initial(self, batch_size: Optional[int] = None) -> T.Tensor:
+        if batch_size is None:
+            return T.zeros(self.hidden_size)
+
+        return T.zeros(batch_size, self.hidden_size)
 
     def save(self, path: pathlib.Path) -> None:
         T.save(self, path)
 
     def infer(self, dataset: PytorchNameCategorization, name: str) -> str:
-        input_tensor = dataset.encode_name(name)
-        hidden_tensor = self.create_hidden_initial()
+        return self.infer_batch(dataset, [name])[0]
+
+    def infer_batch(
+        self, dataset: PytorchNameCategorization, names: Sequence[str]
+    ) -> List[str]:
+        """
+        Infers the culture of many names with a single batched forward pass.
+        """
+
+        names_tensor, lengths, _ = collate_padded(
+            [(dataset.encode_name(name), T.tensor(0)) for name in names]
+        )
 
         training = self.training
 
         try:
             self.eval()
-            for i in range(input_tensor.shape[0]):
-                output_tensor, hidden_tensor = self.forward(
-                    input_tensor[i], hidden_tensor
-                )
+
+            with T.no_grad():
+                output_tensor = self.forward_sequence(names_tensor, lengths, fused=True)
         finally:
             if training:
                 self.train()
 
-        return dataset.decode_culture_name(output_tensor)
+        return [dataset.decode_culture_name(output) for output in output_tensor]
+
+
+@T.jit.script
+def _forward_sequence_fused(
+    names: T.Tensor,
+    lengths: T.Tensor,
+    input_to_hidden_weight: T.Tensor,
+    input_to_hidden_bias: T.Tensor,
+    input_to_output_weight: T.Tensor,
+    input_to_output_bias: T.Tensor,
+) -> T.Tensor:
+    """
+    Computes ``NameClassificationRNN.forward_sequence`` from the weights of its layers.
+
+    The hidden state has no nonlinearity, so the input half of ``input_to_hidden`` is
+    applied to every character at once with a single matrix multiplication. Only the
+    hidden half is applied per character, in a loop compiled by TorchScript.
+    """
+
+    alphabet_count = names.shape[2]
+
+    # The layers are applied to the input and hidden tensors concatenated in that order,
+    # so their weights are split the same way
+    hidden_from_input = (
+        T.matmul(names, input_to_hidden_weight[:, :alphabet_count].t())
+        + input_to_hidden_bias
+    )
+    hidden_from_hidden_weight = input_to_hidden_weight[:, alphabet_count:].t()
+
+    # The hidden tensor going into each character, of which the one going into the last
+    # character of each name is what the output uses
+    hiddens = [
+        T.zeros(
+            names.shape[0],
+            hidden_from_hidden_weight.shape[0],
+            dtype=names.dtype,
+            device=names.device,
+        )
+    ]
+
+    for step in range(names.shape[1] - 1):
+        hiddens.append(
+            hidden_from_input[:, step]
+            + T.matmul(hiddens[-1], hidden_from_hidden_weight)
+        )
+
+    batch_indices = T.arange(names.shape[0], device=names.device)
+    last_steps = (lengths - 1).clamp(0)
+    last_hidden = T.stack(hiddens, 1)[batch_indices, last_steps]
+    last_names = names[batch_indices, last_steps] * (lengths > 0).unsqueeze(1)
+
+    output = (
+        T.matmul(last_names, input_to_output_weight[:, :alphabet_count].t())
+        + T.matmul(last_hidden, input_to_output_weight[:, alphabet_count:].t())
+        + input_to_output_bias
+    )
+
+    return T.log_softmax(output, dim=-1)
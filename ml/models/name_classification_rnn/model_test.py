@@ -0,0 +1,82 @@
+# Copyright (c) 2023 Sophie Katz
+#
+# This file is part of Sophie's ML Monorepo.
+#
+# Sophie's ML Monorepo is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Sophie's ML Monorepo is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Sophie's
+# ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
+
+from ml.data.pytorch_name_classification.pytorch import collate_padded
+from ml.models.name_classification_rnn.model import NameClassificationRNN
+from typing import List, Tuple
+import torch as T
+
+ALPHABET_COUNT = 10
+CULTURE_NAME_COUNT = 5
+
+
+def _make_batch() -> Tuple[List[T.Tensor], T.Tensor, T.Tensor]:
+    generator = T.Generator().manual_seed(0)
+
+    names = [
+        T.eye(ALPHABET_COUNT)[
+            T.randint(0, ALPHABET_COUNT, (length,), generator=generator)
+        ]
+        for length in (1, 7, 3, 12, 5)
+    ]
+
+    padded, lengths, _ = collate_padded([(name, T.tensor(0)) for name in names])
+
+    return names, padded, lengths
+
+
+def _forward_per_character(model: NameClassificationRNN, name: T.Tensor) -> T.Tensor:
+    hidden = model.create_hidden_initial()
+
+    for i in range(name.shape[0]):
+        output, hidden = model.forward(name[i], hidden)
+
+    return output
+
+
+def test_forward_sequence() -> None:
+    T.manual_seed(0)
+    model = NameClassificationRNN(16, ALPHABET_COUNT, CULTURE_NAME_COUNT)
+    names, padded, lengths = _make_batch()
+
+    outputs = model.forward_sequence(padded, lengths)
+
+    assert outputs.shape == (len(names), CULTURE_NAME_COUNT)
+
+    for name, output in zip(names, outputs):
+        assert T.allclose(output, _forward_per_character(model, name), atol=1e-6)
+
+
+def test_forward_sequence_fused() -> None:
+    T.manual_seed(0)
+    model = NameClassificationRNN(16, ALPHABET_COUNT, CULTURE_NAME_COUNT)
+    _, padded, lengths = _make_batch()
+    labels = T.arange(len(lengths)) % CULTURE_NAME_COUNT
+
+    outputs = model.forward_sequence(padded, lengths)
+    T.nn.functional.nll_loss(outputs, labels).backward()  # type: ignore
+    gradients = [parameter.grad.clone() for parameter in model.parameters()]  # type: ignore
+
+    model.zero_grad()
+
+    outputs_fused = model.forward_sequence(padded, lengths, fused=True)
+    T.nn.functional.nll_loss(outputs_fused, labels).backward()  # type: ignore
+    gradients_fused = [parameter.grad for parameter in model.parameters()]
+
+    assert T.allclose(outputs_fused, outputs, atol=1e-5)
+
+    for gradient_fused, gradient in zip(gradients_fused, gradients):
+        assert gradient_fused is not None
+        assert T.allclose(gradient_fused, gradient, atol=1e-5)
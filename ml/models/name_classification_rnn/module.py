@@ -15,7 +15,7 @@
 
 from ml.data.pytorch_name_classification.pytorch import PytorchNameCategorization
 from ml.models.name_classification_rnn.model import NameClassificationRNN
-from typing import cast, Dict, Optional, Tuple
+from typing import cast, Dict, Tuple
 import torch as T
 import torch.nn as nn
 import torch.optim as O
@@ -36,33 +36,28 @@ class NameClassificationRNNModule(pl.LightningModule):  # type: ignore
         self.culture_name_counts_predicted: Dict[int, int] = {}
 
     def training_step(
-        self, batch: Tuple[T.Tensor, T.Tensor], batch_index: int
+        self, batch: Tuple[T.Tensor, T.Tensor, T.Tensor], batch_index: int
     ) -> T.Tensor:
-        name, culture_label = batch
-        culture_predicted: Optional[T.Tensor] = None
+        names, lengths, culture_labels = batch
 
-        hidden = self.model.create_hidden_initial().to(self.device)
+        cultures_predicted = self.model.forward_sequence(names, lengths, fused=True)
 
-        for i in range(name.shape[0]):
-            culture_predicted, hidden = self.model(name[i], hidden)
+        loss = self.loss_fn(cultures_predicted, culture_labels)
 
-        assert culture_predicted is not None
+        self.log("train_loss", loss, batch_size=len(culture_labels))
 
-        loss = self.loss_fn(culture_predicted, culture_label)
+        for culture_name_index_label, culture_name_index_predicted in zip(
+            culture_labels.tolist(), cultures_predicted.argmax(dim=1).tolist()
+        ):
+            if not culture_name_index_label in self.culture_name_counts_label:
+                self.culture_name_counts_label[culture_name_index_label] = 1
+            else:
+                self.culture_name_counts_label[culture_name_index_label] += 1
 
-        self.log("train_loss", loss)
-
-        culture_name_index_label = culture_label.item()
-        if not culture_name_index_label in self.culture_name_counts_label:
-            self.culture_name_counts_label[int(culture_name_index_label)] = 1
-        else:
-            self.culture_name_counts_label[int(culture_name_index_label)] += 1
-
-        culture_name_index_predicted = culture_predicted.argmax().item()
-        if not culture_name_index_predicted in self.culture_name_counts_predicted:
-            self.culture_name_counts_predicted[int(culture_name_index_predicted)] = 1
-        else:
-            self.culture_name_counts_predicted[int(culture_name_index_predicted)] += 1
+            if not culture_name_index_predicted in self.culture_name_counts_predicted:
+                self.culture_name_counts_predicted[culture_name_index_predicted] = 1
+            else:
+                self.culture_name_counts_predicted[culture_name_index_predicted] += 1
 
         return cast(T.Tensor, loss)
 
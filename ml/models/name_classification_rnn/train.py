@@ -13,13 +13,22 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
-from ml.data.pytorch_name_classification.pytorch import PytorchNameCategorization
+from ml.data.pytorch_name_classification.pytorch import (
+    collate_padded,
+    NameLengthBatchSampler,
+    PytorchNameCategorization,
+)
 from ml.models.name_classification_rnn.model import HIDDEN_SIZE, NameClassificationRNN
 import torch as T
 import lightning.pytorch as pl
 from ml.models.name_classification_rnn.module import NameClassificationRNNModule
 from ml.core.repo_paths import get_dir_models
 
+BATCH_SIZE = 32
+
+# The number of optimizer steps to train for, each on one batch of names
+TRAINING_STEPS = 10000
+
 
 def train() -> NameClassificationRNN:
     dataset = PytorchNameCategorization()
@@ -38,8 +47,12 @@ def train() -> NameClassificationRNN:
         module,
         train_dataloaders=T.utils.data.DataLoader(
             dataset,
-            sampler=T.utils.data.RandomSampler(dataset, num_samples=10000),
-            batch_size=None,
+            batch_sampler=NameLengthBatchSampler(
+                dataset.name_lengths(),
+                BATCH_SIZE,
+                num_samples=TRAINING_STEPS * BATCH_SIZE,
+            ),
+            collate_fn=collate_padded,
         ),
     )
 
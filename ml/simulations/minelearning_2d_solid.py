@@ -18,9 +18,34 @@ import numpy.typing as npt
 import numpy as np
 import dataclasses
 import math
-from typing import cast, List, Tuple, Optional
+from typing import Optional, Sequence, Tuple
 
-SampleType = np.int8
+SampleType = np.uint8
+
+# Fields which the cached configuration is derived from
+_CONFIG_FIELDS = frozenset(("width", "height", "square_size", "colors"))
+
+
+@dataclasses.dataclass(frozen=True)
+class _Config:
+    """
+    The configuration of a ``SimulationMineLearning2DSolid`` after it has been validated
+    and normalized.
+    """
+
+    # The colors as a read-only, C-contiguous array of shape (colors, channels)
+    palette: npt.NDArray[SampleType]
+
+    # The number of grid squares needed to cover the image, including the cropped
+    # squares at the right and bottom edges
+    grid_height: int
+    grid_width: int
+
+    # The number of rows of grid squares which aren't cropped at the bottom edge
+    full_rows: int
+
+    # The shape of a single output image
+    output_shape: Tuple[int, int, int]
 
 
 @dataclasses.dataclass
@@ -177,6 +202,24 @@ class SimulationMineLearning2DSolid(
     square_size: int
     colors: npt.ArrayLike
 
+    # Validated configuration, computed on first use and reset when any of the fields
+    # above are reassigned. Mutating ``colors`` in place isn't detected.
+    _config: Optional[_Config] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    # Output buffer reused between calls to ``step_batch`` with ``reuse_output=True``
+    _output_buffer: Optional[npt.NDArray[SampleType]] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __setattr__(self, name: str, value: object) -> None:
+        super().__setattr__(name, value)
+
+        if name in _CONFIG_FIELDS:
+            super().__setattr__("_config", None)
+            super().__setattr__("_output_buffer", None)
+
     def start(self) -> None:
         pass
 
@@ -185,52 +228,132 @@ class SimulationMineLearning2DSolid(
     ) -> Tuple[npt.NDArray[SampleType], None]:
         assert input is not None, "input is expected to be a 2D array of color indexes"
 
-        # Ensure that properties are valid
-        self._validate()
-
-        # Create empty result
-        result: List[List[npt.NDArray[SampleType]]] = []
-
-        # Populate result
-        for y in range(self.height):
-            result.append([])
-            for x in range(self.width):
-                pixel = self._get_pixel(x, y, input)
-                assert len(np.shape(pixel)) == 1
-                result[-1].append(pixel)
-
-        # Return result
-        return np.array(result), None
-
-    def _validate(self) -> None:
-        # Validate properties
-        assert self.width > 0
-        assert self.height > 0
-        assert self.square_size > 0
-        assert len(np.shape(self.colors)) == 2
-
-    def _get_pixel(
-        self, x: int, y: int, input: npt.ArrayLike
-    ) -> npt.NDArray[SampleType]:
-        # Validate parameters
-        assert x >= 0
-        assert x < self.width
-        assert y >= 0
-        assert y < self.height
-        assert len(np.shape(input)) == 2
-
-        # Calculate the grid index
-        grid_x = x // self.square_size
-        grid_y = y // self.square_size
-
-        # Get the color index from the input
-        assert grid_y < np.shape(input)[0]
-        assert grid_x < np.shape(input)[1]
-        color_index: int = np.array(input)[grid_y, grid_x]
-
-        # Return the color at the given index
-        assert color_index < np.shape(self.colors)[0]
-        return cast(
-            npt.NDArray[SampleType],
-            np.array(self.colors)[color_index],
-        )
+        config = self._get_config()
+
+        grid = np.asarray(input)
+        assert len(np.shape(grid)) == 2
+
+        output = np.empty(config.output_shape, dtype=SampleType)
+        self._render(config, grid[np.newaxis], output[np.newaxis])
+
+        return output, None
+
+    def step_batch(  # type: ignore[override]
+        self,
+        states: Optional[Sequence[None]] = None,
+        inputs: Optional[npt.ArrayLike] = None,
+        count: Optional[int] = None,
+        out: Optional[npt.NDArray[SampleType]] = None,
+        reuse_output: bool = False,
+    ) -> Tuple[npt.NDArray[SampleType], None]:
+        """
+        Renders a batch of images at once into a single array of shape
+        ``(N, height, width, channels)``.
+
+        Parameters
+        ----------
+        inputs: Optional[npt.ArrayLike]
+            The grid of color indexes for each image, either as a sequence of 2D arrays
+            with the same shape or as a single 3D array.
+        out: Optional[npt.NDArray[SampleType]]
+            A C-contiguous array of shape ``(N, height, width, channels)`` and type
+            ``SampleType`` to render into. If given, it's also returned.
+        reuse_output: bool
+            If true and ``out`` isn't given, an array owned by the simulation is
+            rendered into and returned, which is overwritten by the next call with
+            ``reuse_output=True``. This avoids allocating for every batch.
+        """
+
+        assert (
+            inputs is not None
+        ), "inputs are expected to be 2D arrays of color indexes"
+
+        config = self._get_config()
+
+        grids = np.asarray(inputs)
+        assert len(np.shape(grids)) == 3
+        assert count is None or count == np.shape(grids)[0]
+
+        output_shape = (np.shape(grids)[0], *config.output_shape)
+
+        if out is None:
+            if reuse_output:
+                if (
+                    self._output_buffer is None
+                    or np.shape(self._output_buffer)[0] < output_shape[0]
+                ):
+                    self._output_buffer = np.empty(output_shape, dtype=SampleType)
+
+                out = self._output_buffer[: output_shape[0]]
+            else:
+                out = np.empty(output_shape, dtype=SampleType)
+
+        assert np.shape(out) == output_shape
+        assert out.dtype == SampleType
+        assert out.flags.c_contiguous
+
+        self._render(config, grids, out)
+
+        return out, None
+
+    def _get_config(self) -> _Config:
+        if self._config is None:
+            # Ensure that properties are valid
+            colors = np.asarray(self.colors)
+
+            assert self.width > 0
+            assert self.height > 0
+            assert self.square_size > 0
+            assert len(np.shape(colors)) == 2
+            assert (colors >= np.iinfo(SampleType).min).all()
+            assert (colors <= np.iinfo(SampleType).max).all()
+
+            palette = np.array(colors, dtype=SampleType, order="C")
+            palette.setflags(write=False)
+
+            self._config = _Config(
+                palette=palette,
+                grid_height=math.ceil(self.height / self.square_size),
+                grid_width=math.ceil(self.width / self.square_size),
+                full_rows=self.height // self.square_size,
+                output_shape=(self.height, self.width, np.shape(palette)[1]),
+            )
+
+        return self._config
+
+    def _render(
+        self,
+        config: _Config,
+        grids: npt.NDArray[np.integer],
+        out: npt.NDArray[SampleType],
+    ) -> None:
+        """
+        Renders each grid of color indexes in ``grids``, which has shape
+        ``(N, rows, columns)``, into ``out``, which has shape
+        ``(N, height, width, channels)``.
+        """
+
+        assert np.shape(grids)[1] >= config.grid_height
+        assert np.shape(grids)[2] >= config.grid_width
+
+        grids = grids[:, : config.grid_height, : config.grid_width]
+
+        assert (grids < np.shape(config.palette)[0]).all()
+
+        # Look up the color of each grid square and expand the squares horizontally,
+        # cropping the squares at the right edge when the width isn't a multiple of the
+        # square size. This is smaller than the output by a factor of square_size.
+        rows = np.repeat(config.palette[grids], self.square_size, axis=2)[
+            :, :, : self.width
+        ]
+
+        # Expand the squares vertically by broadcasting each row of squares over a view
+        # of the output where every square_size rows of pixels are grouped together,
+        # then fill the cropped squares at the bottom edge
+        full_rows = config.full_rows
+        out[:, : full_rows * self.square_size].reshape(
+            np.shape(out)[0], full_rows, self.square_size, *np.shape(out)[2:]
+        )[...] = rows[:, :full_rows, np.newaxis]
+
+        if self.height % self.square_size != 0:
+            out[:, full_rows * self.square_size :] = rows[:, full_rows, np.newaxis]
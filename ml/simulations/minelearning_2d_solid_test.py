@@ -13,7 +13,8 @@
 # You should have received a copy of the GNU General Public License along with Sophie's
 # ML Monorepo. If not, see <https://www.gnu.org/licenses/>.
 
-from .minelearning_2d_solid import SimulationMineLearning2DSolid
+from .minelearning_2d_solid import SampleType, SimulationMineLearning2DSolid
+import numpy as np
 
 
 def test_width_2_height_2_square_size_1_colors_1() -> None:
@@ -238,3 +239,75 @@ def test_width_5_height_5_square_size_2_colors_3() -> None:
             ],
         ]
     ).all()
+
+
+def test_step_batch() -> None:
+    simulation = SimulationMineLearning2DSolid(
+        5, 3, 2, [(0xFF, 0x00, 0x00), (0x00, 0xFF, 0x00), (0x00, 0x00, 0xFF)]
+    )
+
+    inputs = np.random.default_rng(0).integers(0, 3, size=(4, 2, 3))
+
+    output, _ = simulation.step_batch(inputs=inputs)
+
+    assert output.shape == (4, 3, 5, 3)
+    assert output.dtype == SampleType
+
+    for i in range(4):
+        assert (output[i] == simulation.step(input=inputs[i])[0]).all()
+
+
+def test_step_batch_out() -> None:
+    simulation = SimulationMineLearning2DSolid(2, 2, 1, [(1, 2, 3), (4, 5, 6)])
+
+    out = np.zeros((2, 2, 2, 3), dtype=SampleType)
+
+    output, _ = simulation.step_batch(
+        inputs=[[[0, 1], [0, 1]], [[1, 1], [1, 0]]], out=out
+    )
+
+    assert output is out
+    assert (out[0, :, 0] == [1, 2, 3]).all()
+    assert (out[0, :, 1] == [4, 5, 6]).all()
+    assert (out[1, 1, 1] == [1, 2, 3]).all()
+
+
+def test_step_batch_reuse_output() -> None:
+    simulation = SimulationMineLearning2DSolid(2, 2, 1, [(1, 2, 3), (4, 5, 6)])
+
+    first, _ = simulation.step_batch(inputs=[[[0, 0], [0, 0]]], reuse_output=True)
+    second, _ = simulation.step_batch(inputs=[[[1, 1], [1, 1]]], reuse_output=True)
+
+    assert np.shares_memory(first, second)
+    assert (second == [4, 5, 6]).all()
+
+
+def test_config_cached() -> None:
+    simulation = SimulationMineLearning2DSolid(2, 2, 1, [(1, 2, 3), (4, 5, 6)])
+
+    simulation.step(input=[[0, 1], [1, 0]])
+    config = simulation._config
+
+    simulation.step(input=[[1, 1], [1, 0]])
+
+    assert config is not None
+    assert simulation._config is config
+    assert config.palette.dtype == SampleType
+    assert config.palette.flags.c_contiguous
+    assert not config.palette.flags.writeable
+
+
+def test_config_invalidated_on_reassignment() -> None:
+    simulation = SimulationMineLearning2DSolid(2, 2, 1, [(1, 2, 3)])
+
+    simulation.step_batch(inputs=[[[0, 0], [0, 0]]], reuse_output=True)
+
+    simulation.colors = [(7, 8, 9, 10)]
+    simulation.width = 3
+
+    output, _ = simulation.step_batch(
+        inputs=[[[0, 0, 0], [0, 0, 0]]], reuse_output=True
+    )
+
+    assert output.shape == (1, 2, 3, 4)
+    assert (output == [7, 8, 9, 10]).all()